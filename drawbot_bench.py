@@ -0,0 +1,265 @@
+# Benchmarks for the conversion and drawing pipeline.
+#
+# Run with:
+# python drawbot_bench.py --output data/bench/$(git rev-parse --short HEAD).json
+# python drawbot_bench.py --compare data/bench/before.json data/bench/after.json
+#
+# Every case runs in a fresh process, so its peak memory is its own and nothing is
+# warmed up by an earlier case. Inputs are generated from a fixed seed, and any
+# recorded g-code (e.g. data/uploaded/*/output.gcode) is benchmarked as well.
+
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# Segments per synthetic stroke
+STROKE_SEGMENTS = 50
+
+
+def bench_setup():
+    from drawbot_converter.bot_setup import BotSetup
+    # The same setup the server starts with
+    return BotSetup().standard_magnets().a3_paper().rodalm_21_30()
+
+
+def synthetic_svg(path: str, segments: int, seed=0):
+    """Random-walk polylines totalling `segments` line segments, on an A4 sized page"""
+    rng = random.Random(seed)
+    with open(path, 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="210mm" height="297mm" viewBox="0 0 210 297">\n')
+        for first in range(0, segments, STROKE_SEGMENTS):
+            x, y = rng.uniform(10, 200), rng.uniform(10, 287)
+            points = [f"M{x:.2f},{y:.2f}"]
+            for _ in range(min(STROKE_SEGMENTS, segments - first)):
+                x = min(max(x + rng.uniform(-3, 3), 0), 210)
+                y = min(max(y + rng.uniform(-3, 3), 0), 297)
+                points.append(f"L{x:.2f},{y:.2f}")
+            f.write(f'<path d="{" ".join(points)}" fill="none" stroke="black"/>\n')
+        f.write('</svg>\n')
+
+
+def synthetic_gcode(path: str, segments: int, setup, seed=0):
+    """Random-walk strokes in bot coordinates, in the format the converter writes"""
+    rng = random.Random(seed)
+    x0, x1 = setup.x_margins + 10, setup.bot_width - setup.x_margins - 10
+    y0, y1 = setup.minimum_y_offset + 10, setup.bot_height - 10
+    with open(path, 'w') as f:
+        for first in range(0, segments, STROKE_SEGMENTS):
+            x, y = rng.uniform(x0, x1), rng.uniform(y0, y1)
+            f.write(f"g{x:.2f},{y:.2f}\nd1\n")
+            for _ in range(min(STROKE_SEGMENTS, segments - first)):
+                x = min(max(x + rng.uniform(-2, 2), x0), x1)
+                y = min(max(y + rng.uniform(-2, 2), y0), y1)
+                f.write(f"g{x:.2f},{y:.2f}\n")
+            f.write("d0\n")
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_convert(workdir: str, segments: int) -> dict:
+    import drawbot_conversion
+    setup = bench_setup()
+    synthetic_svg(f"{workdir}/input.svg", segments)
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    stats = drawbot_conversion.convert(workdir, setup)
+    return {
+        'seconds': time.perf_counter() - start,
+        'stages': stats['stage_times'],
+        'commands': stats['commands_after'],
+        'peak_rss_mb': _peak_rss_mb(),
+        'baseline_rss_mb': baseline,
+    }
+
+
+def _prepare_gcode(workdir: str, segments: int = None, source: str = None) -> str:
+    import drawbot_gcode
+    path = f"{workdir}/output.gcode"
+    if source:
+        shutil.copy(source, path)
+    else:
+        synthetic_gcode(path, segments, bench_setup())
+    drawbot_gcode.write_index(path)
+    return path
+
+
+def run_send(workdir: str, segments: int = None, source: str = None) -> dict:
+    """Commands per second through send_file with a zero delay fake drawbot"""
+    from drawbot_control import DrawbotControl, FakeDrawbotOutput
+    path = _prepare_gcode(workdir, segments, source)
+    controller = DrawbotControl([FakeDrawbotOutput(fake_delay=0, verbose=False)], verbose=False)
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    controller.send_file(path, bench_setup())
+    seconds = time.perf_counter() - start
+    commands = controller.run_stats.commands
+    return {
+        'seconds': seconds,
+        'commands': commands,
+        'commands_per_second': commands / seconds if seconds else 0.0,
+        'peak_rss_mb': _peak_rss_mb(),
+        'baseline_rss_mb': baseline,
+    }
+
+
+def run_png(workdir: str, segments: int = None, source: str = None) -> dict:
+    """Cost of drawing into PNGOutput and of encoding the preview"""
+    from drawbot_control import DrawbotControl, PNGOutput
+    path = _prepare_gcode(workdir, segments, source)
+    png = PNGOutput(f"{workdir}/preview.png", verbose=False, max_size=2048)
+    controller = DrawbotControl([png], verbose=False)
+    setup = bench_setup()
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    controller.send_file(path, setup)
+    # The preview is fed from its own thread; include catching up with the drawing
+    controller.flush_outputs(timeout=600)
+    seconds = time.perf_counter() - start
+    commands = controller.run_stats.commands
+    # The encoder keeps its copy of the finished drawing; time full encodes of it on their own
+    encodes = []
+    for _ in range(3):
+        png.encoder.submit((0, 0), png.encoder.image.copy(), reset=True)
+        png.encoder.flush()
+        encodes.append(png.encoder.last_encode_time)
+    return {
+        'seconds': seconds,
+        'commands': commands,
+        'commands_per_second': commands / seconds if seconds else 0.0,
+        'encode_seconds': min(encodes),
+        'png_bytes': os.path.getsize(f"{workdir}/preview.png"),
+        'peak_rss_mb': _peak_rss_mb(),
+        'baseline_rss_mb': baseline,
+    }
+
+
+def _run_case(function, kwargs) -> dict:
+    # The report goes to stdout, so what the drawing code prints, from any thread, goes to stderr
+    sys.stdout = sys.stderr
+    workdir = tempfile.mkdtemp(prefix="drawbot-bench-")
+    try:
+        return function(workdir, **kwargs)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run_case(name: str, function, repeat: int, **kwargs) -> dict:
+    """Best of `repeat` runs, each in a new process"""
+    best = None
+    for _ in range(repeat):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            try:
+                result = pool.submit(_run_case, function, kwargs).result()
+            except Exception as e:
+                print(f"{name}: failed: {e}", file=sys.stderr)
+                return {'error': str(e)}
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    summary = f"{best['seconds']:.3f}s"
+    if 'commands_per_second' in best:
+        summary += f", {best['commands_per_second']:.0f} commands/s"
+    print(f"{name}: {summary}, peak {best['peak_rss_mb']:.0f}MB", file=sys.stderr)
+    return best
+
+
+def run_all(sizes, repeat: int, gcode_files, skip_convert=False) -> dict:
+    results = {}
+    for segments in sizes:
+        if not skip_convert:
+            results[f"convert/{segments}"] = run_case(f"convert/{segments}", run_convert, repeat, segments=segments)
+        results[f"send/{segments}"] = run_case(f"send/{segments}", run_send, repeat, segments=segments)
+        results[f"png/{segments}"] = run_case(f"png/{segments}", run_png, repeat, segments=segments)
+    for source in gcode_files:
+        name = os.path.basename(os.path.dirname(source)) or os.path.basename(source)
+        results[f"send/{name}"] = run_case(f"send/{name}", run_send, repeat, source=source)
+        results[f"png/{name}"] = run_case(f"png/{name}", run_png, repeat, source=source)
+    return results
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(before: dict, after: dict, threshold=0.1) -> bool:
+    """Print the change in time for every case in both files; returns False if any got slower"""
+    ok = True
+    print(f"{'case':32} {'before':>10} {'after':>10} {'change':>8}")
+    for name, result in after['results'].items():
+        old = before['results'].get(name)
+        if not old or 'seconds' not in old or 'seconds' not in result:
+            continue
+        change = result['seconds'] / old['seconds'] - 1 if old['seconds'] else 0.0
+        flag = ""
+        if change > threshold:
+            flag = " SLOWER"
+            ok = False
+        elif change < -threshold:
+            flag = " faster"
+        print(f"{name:32} {old['seconds']:10.3f} {result['seconds']:10.3f} {change:+8.1%}{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark drawbot conversion and drawing")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="Synthetic drawing sizes in segments, e.g. 1000 10000 100000 1000000")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the fastest is kept")
+    parser.add_argument('--gcode', nargs='*', default=None,
+                        help="Recorded g-code files to benchmark (default: data/uploaded/*/output.gcode)")
+    parser.add_argument('--skip-convert', action='store_true', help="Skip the SVG conversion cases")
+    parser.add_argument('--output', help="Write the JSON results here instead of to stdout")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        sys.exit(0 if compare(before, after) else 1)
+
+    gcode_files = args.gcode if args.gcode is not None else sorted(glob.glob('data/uploaded/*/output.gcode'))
+    with contextlib.redirect_stdout(sys.stderr):
+        report = {'environment': environment(),
+                  'results': run_all(args.sizes, args.repeat, gcode_files, args.skip_convert)}
+    text = json.dumps(report, indent=1)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
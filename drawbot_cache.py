@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from importlib import metadata
+
+import drawbot_paths
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+def converter_version() -> str:
+    """Version string covering everything that turns an SVG into drawing artifacts"""
+    try:
+        converter = metadata.version('drawbot_converter')
+    except metadata.PackageNotFoundError:
+        converter = "unknown"
+    return f"{converter}/{drawbot_paths.PROCESSING_VERSION}"
+
+
+class ConversionCache:
+    """Content-addressed store of conversion outputs, keyed on the input SVG and BotSetup.
+
+    Each entry is a directory named by the key holding the converted artifacts. A hit
+    hard-links them (or copies, across filesystems) into the upload directory. The
+    entry's mtime records its last use, and the least recently used entries are
+    evicted once the cache grows beyond max_bytes.
+    """
+    ARTIFACTS = ['processed.svg', 'converted.gcode', 'output.gcode', 'output.gcode.idx',
+                 'gcode_check.svg', 'check.svg', 'process_stats.json', 'thumbnail.png',
+                 'check.png']
+
+    def __init__(self, cache_dir='data/cache', max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, input_path: str, setup) -> str:
+        digest = hashlib.sha256()
+        with open(input_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        digest.update(json.dumps(vars(setup), sort_keys=True, default=str).encode('utf-8'))
+        digest.update(converter_version().encode('utf-8'))
+        # An entry from before an artifact was added would be missing it
+        digest.update(json.dumps(self.ARTIFACTS).encode('utf-8'))
+        return digest.hexdigest()
+
+    def clear_artifacts(self, target_dir: str):
+        """Unlink previous artifacts so a new conversion never writes through a link into the cache"""
+        for name in self.ARTIFACTS:
+            try:
+                os.remove(os.path.join(target_dir, name))
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, key: str, target_dir: str) -> bool:
+        """Place the cached artifacts for key into target_dir, returning whether there was a hit"""
+        entry = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            for name in os.listdir(entry):
+                _link_or_copy(os.path.join(entry, name), os.path.join(target_dir, name))
+            os.utime(entry)
+        except OSError as e:
+            print(f"Conversion cache entry {key} unusable: {e}")
+            self.clear_artifacts(target_dir)
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+        print(f"Conversion cache hit {key[:12]}")
+        return True
+
+    def store(self, key: str, source_dir: str):
+        """Add the artifacts in source_dir to the cache under key"""
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            os.utime(entry)
+            return
+        # Build the entry under a temporary name so concurrent conversions never see it half written
+        tmp_entry = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}")
+        try:
+            os.makedirs(tmp_entry)
+            for name in self.ARTIFACTS:
+                path = os.path.join(source_dir, name)
+                if os.path.exists(path):
+                    _link_or_copy(path, os.path.join(tmp_entry, name))
+            os.rename(tmp_entry, entry)
+        except OSError as e:
+            print(f"Could not store conversion cache entry {key}: {e}")
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print(f"Evicting conversion cache entry {os.path.basename(path)[:12]}")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def _link_or_copy(source: str, target: str):
+    # Never write into an existing file, it may itself be a link into another entry
+    try:
+        os.remove(target)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
@@ -0,0 +1,135 @@
+# Checkpoints of how far a drawing got, so an interrupted drawing can be resumed
+# instead of redrawn from the first command.
+
+import json
+import os
+import time
+from collections import deque
+
+import drawbot_gcode
+from drawbot_gcode import OP_PEN, OP_MOVE
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+def checkpoint_path(filepath: str) -> str:
+    return os.path.join(os.path.dirname(filepath), 'checkpoint.json')
+
+
+def file_fingerprint(filepath: str, total: int) -> dict:
+    """What a checkpoint's command index refers to; resuming is refused if any of it changes"""
+    stat = os.stat(filepath)
+    # Indexes count every non-empty line; checkpoints saved while drawings were also sent
+    # from a compiled form without comments have another format and are refused
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'format': 'text', 'total': total}
+
+
+def load_checkpoint(filepath: str, fingerprint: dict = None) -> dict:
+    """Return the checkpoint saved for a g-code file, or None if there is none or it is stale"""
+    try:
+        with open(checkpoint_path(filepath)) as f:
+            checkpoint = json.load(f)
+        stat = os.stat(filepath)
+    except (OSError, ValueError):
+        return None
+    saved = checkpoint.get('fingerprint', {})
+    if saved.get('size') != stat.st_size or saved.get('mtime') != stat.st_mtime:
+        return None
+    if fingerprint is not None and saved != fingerprint:
+        return None
+    return checkpoint
+
+
+def clear_checkpoint(filepath: str):
+    try:
+        os.remove(checkpoint_path(filepath))
+    except FileNotFoundError:
+        pass
+
+
+class Checkpoint:
+    """Follows a block as it is sent and saves the last acknowledged position in the file.
+
+    send_block reports each command sent, and the number of commands acknowledged
+    whenever a save is due. The pen state and position after every command still in
+    flight is kept so the state at the acknowledged command can be saved, not the
+    state at the last command sent. Saves happen at most every `interval` seconds,
+    so the cost stays bounded however fast commands go.
+    """
+    def __init__(self, filepath: str, fingerprint: dict, start=0, prologue=0, pen_down=False,
+                 position=(380.0, 250.0), interval=2.0, bot: str = None):
+        """
+        Args:
+            filepath: The g-code file being drawn
+            fingerprint: file_fingerprint() of the file
+            start: Index in the file of the first file command in the block
+            prologue: Number of commands sent before the first file command
+            pen_down: Pen state before the block starts
+            position: Pen position before the block starts
+            interval: Minimum seconds between saves
+            bot: Name of the bot drawing it, as the paper is on that bot
+        """
+        self.path = checkpoint_path(filepath)
+        self.fingerprint = fingerprint
+        self.start = start
+        self.prologue = prologue
+        self.interval = interval
+        self.bot = bot
+        self.next_save = 0.0
+        self.frozen = False
+        self._acked_state = (pen_down, position)
+        self._states = deque()
+        self._pen_down = pen_down
+        self._position = position
+
+    @property
+    def pen_down(self) -> bool:
+        """Pen state after the last command sent"""
+        return self._pen_down
+
+    @property
+    def position(self):
+        """Pen position after the last command sent"""
+        return self._position
+
+    def sent(self, index: int, command):
+        """Note a command that has been written to the outputs"""
+        op, x, y = drawbot_gcode.parse_command(command)
+        if op == OP_PEN:
+            self._pen_down = x == 1
+        elif op == OP_MOVE:
+            self._position = (x, y)
+        else:
+            return
+        self._states.append((index, self._pen_down, self._position))
+
+    def save(self, acked: int):
+        """Save the state once the first `acked` commands of the block have been acknowledged"""
+        if self.frozen:
+            return
+        while self._states and self._states[0][0] < acked:
+            _, pen_down, position = self._states.popleft()
+            self._acked_state = (pen_down, position)
+        pen_down, position = self._acked_state
+        checkpoint = {
+            'index': min(self.start + max(acked - self.prologue, 0), self.fingerprint['total']),
+            'pen_down': pen_down,
+            'position': list(position),
+            'time': time.time(),
+            'bot': self.bot,
+            'fingerprint': self.fingerprint,
+        }
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(checkpoint, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save checkpoint {self.path}: {e}")
+        self.next_save = time.perf_counter() + self.interval
+
+    def freeze(self, acked: int):
+        """Save the state before a failed command and keep it, whatever is sent afterwards"""
+        self.save(acked)
+        self.frozen = True
@@ -3,18 +3,35 @@ import serial
 from PIL import Image, ImageDraw
 import os
 #from drawbot_server import executor
-from drawbot_server import BotSetup
+from drawbot_converter.bot_setup import BotSetup
 import re
 import fcntl
+import drawbot_gcode
+import drawbot_motion
+import drawbot_thumbnails
+from drawbot_gcode import OP_PEN, OP_MOVE
+from drawbot_stats import RunStats
+from drawbot_motion import MotionModel, TimeEstimator
+from drawbot_checkpoint import Checkpoint, file_fingerprint, load_checkpoint, clear_checkpoint
 import sys
 import time
+import threading
+import json
+import struct
+import numpy as np
+from collections import deque
 from datetime import datetime
-from typing import Optional, Protocol, List, abstractmethod
+from typing import Optional, Protocol, List, Iterable, abstractmethod
+from itertools import chain, islice
 from abc import ABC
 
 import functools
 print = functools.partial(print, flush=True)
 
+# Bytes the firmware's serial receive buffer holds; streaming leaves a few of them free
+FIRMWARE_RX_BUFFER = 64
+STREAM_BUFFER_BYTES = FIRMWARE_RX_BUFFER - 4
+
 
 class StateListener:
     def set_state(self,state:str):
@@ -26,8 +43,22 @@ class StateListener:
     def set_target_image(self,image_path:str):
         pass
 
+class CommandError(IOError):
+    """A command sent to the drawbot failed or was never acknowledged"""
+    def __init__(self, message: str, command: str = None, sequence: int = None):
+        super().__init__(message)
+        self.command = command
+        self.sequence = sequence
+
+
 class DrawbotOutput(ABC):
     """Base class for drawbot output implementations"""
+
+    # RunStats of the block being sent, for outputs that time their own internal stages
+    stats: Optional[RunStats] = None
+    # Primary outputs (the bot) are written from the send loop. Secondary ones (previews,
+    # logs) are fed from their own thread and may lose commands rather than hold the bot up.
+    primary = True
     
     def start_block(self):
         """Initialize the output connection"""
@@ -41,6 +72,19 @@ class DrawbotOutput(ABC):
         """Write a command and return the response"""
         pass
 
+    def write_commands(self, commands: list):
+        """Write a batch of commands; outputs that can draw a batch at once override this"""
+        for command in commands:
+            self.write_command(command)
+
+    def drain(self) -> str:
+        """Wait for any commands still in flight and return their responses"""
+        return ""
+
+    def pending_count(self) -> int:
+        """Number of commands written but not yet acknowledged"""
+        return 0
+
     def start_file(self, filepath: str, setup: BotSetup):
         """Called when starting to process a new file
         
@@ -60,20 +104,101 @@ class DrawbotOutput(ABC):
         pass
 
 
+class _InFlightCommand:
+    """A command that has been written to the serial port but not yet acknowledged"""
+    def __init__(self, sequence: int, command: str, size: int):
+        self.sequence = sequence
+        self.command = command
+        self.size = size
+        self.sent_at = time.time()
+        self.sent_perf = time.perf_counter()
+        self.response = ""
+
+
 class SerialDrawbotOutput(DrawbotOutput):
-    def __init__(self, serialport='/dev/ttyACM0', timeout=120, baud='57600', verbose=True):
+    """The drawbot on a serial port.
+
+    Opening the port resets most Arduino-type boards, which takes seconds, so the
+    port and its lock file are kept open between blocks as one session. A
+    supervisor thread checks the idle port every health_interval seconds and
+    closes it after idle_timeout, letting other processes take the lock. A
+    session whose block failed, or whose port went away, is closed, and the next
+    block opens a new one.
+    """
+    def __init__(self, serialport='/dev/ttyACM0', timeout=120, baud='57600', verbose=True,
+                 window=1, buffer_bytes=None, serial_factory=None, poll_interval=0.1, lock_path="/tmp/feed.lock",
+                 idle_timeout=120.0, health_interval=5.0, connect_attempts=3, retry_delay=2.0):
+        """
+        Args:
+            serialport: Device path of the drawbot
+            timeout: Seconds to wait for a command to be acknowledged
+            baud: Serial baud rate
+            verbose: Whether to print every command and response
+            window: Maximum number of unacknowledged commands. 1 sends a command and waits
+                for its "ok" before sending the next; larger values stream commands ahead
+                of the firmware and match acknowledgements on a reader thread.
+            buffer_bytes: Also limit the bytes in flight to the firmware's receive buffer
+                size (character counting). Defaults to STREAM_BUFFER_BYTES when window > 1,
+                as more bytes than the buffer holds would be dropped by the firmware
+            serial_factory: Callable returning an unopened serial port, defaults to serial.Serial
+            poll_interval: Read timeout used by the streaming reader thread
+            lock_path: File locked while the port is open, so only one process feeds this
+                bot; each bot needs its own
+            idle_timeout: Seconds the port stays open after a block; 0 closes it after
+                every block, None keeps it open until close()
+            health_interval: Seconds between checks of the idle port
+            connect_attempts: Times to try opening the port before a block fails
+            retry_delay: Seconds between those attempts
+        """
         self.serialport = serialport
         self.timeout = timeout
         self.baud = baud
         self.verbose = verbose
+        self.window = max(1, int(window))
+        if buffer_bytes is None and self.window > 1:
+            buffer_bytes = STREAM_BUFFER_BYTES
+        self.buffer_bytes = buffer_bytes
+        self.serial_factory = serial_factory or serial.Serial
+        self.poll_interval = poll_interval
         self.serial_port = None
+        self.lock_path = lock_path
         self.lock_fd = None
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.connect_attempts = max(1, int(connect_attempts))
+        self.retry_delay = retry_delay
+
+        self._session_lock = threading.RLock()
+        self._in_block = False
+        self._block_failed = False
+        self._last_used = 0.0
+        self._supervisor = None
+        self.connects = 0
+        self.reconnects = 0
+        self.health_failures = 0
+        self.idle_closes = 0
+        self.blocks = 0
+        self.connect_time = None
+
+        self._cond = threading.Condition()
+        self._pending = deque()
+        self._completed = []
+        self._in_flight_bytes = 0
+        self._sequence = 0
+        self._error = None
+        self._failed = False
+        self._reader = None
+        self._stop_reader = threading.Event()
+
+    @property
+    def streaming(self):
+        return self.window > 1 or self.buffer_bytes is not None
 
     """
     this requires the robot to respond in the expected way, where all responsed end with "ok"
     """
     def get_lock(self):
-        file = "/tmp/feed.lock"
+        file = self.lock_path
         self.lock_fd = open(file,'w')
         try:
             fcntl.lockf(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
@@ -92,38 +217,158 @@ class SerialDrawbotOutput(DrawbotOutput):
             print(f"Error releasing lock: {e}", file=sys.stderr)
 
     def start_block(self):
-        try:
-            print(f"Starting real serial on {self.serialport}")
-            self.get_lock()
-            self.serial_port = serial.Serial()
-            self.serial_port.port = self.serialport
-            self.serial_port.timeout = self.timeout
-            self.serial_port.writeTimeout = self.timeout
-            self.serial_port.baudrate = self.baud
-            self.serial_port.open()
-            print("serial opened")
-        except IOError as e:
-            self.release_lock()  # Make sure to release lock if serial fails
-            print("robot not connected?", e)
-            raise e
+        with self._session_lock:
+            self._in_block = True
+            self._block_failed = False
+            try:
+                if self.serial_port is not None and not self._healthy():
+                    print(f"serial connection to {self.serialport} lost, reconnecting", file=sys.stderr)
+                    self.health_failures += 1
+                    self.reconnects += 1
+                    self._close_session()
+                if self.serial_port is None:
+                    self._connect()
+                else:
+                    # Anything the bot sent since the last block would be taken for an "ok"
+                    self._discard_input()
+            except IOError:
+                self._in_block = False
+                raise
+            self.blocks += 1
+        if self.streaming:
+            self.start_reader()
 
     def finish_block(self):
-        try:
-            if self.verbose:
+        with self._session_lock:
+            self._in_block = False
+            self._last_used = time.monotonic()
+            if self._block_failed or self._failed or self._error is not None or self.idle_timeout == 0:
+                # After a failure the bot and the port are in an unknown state, start afresh next time
+                self.close()
+            elif self._supervisor is None:
+                self._supervisor = threading.Thread(target=self._supervise, name="drawbot-serial-session",
+                                                    daemon=True)
+                self._supervisor.start()
+
+    def close(self):
+        """End the session: close the port and release the lock"""
+        with self._session_lock:
+            if self.serial_port is not None and self.verbose:
                 print("closing serial")
-            if self.serial_port:
-                self.serial_port.close()
-                self.serial_port = None
-            self.release_lock()  # Release lock when finishing
-        except IOError as e:
-            print("robot not connected?", e)
-            raise e
+            self._close_session()
+
+    def _connect(self, attempts: int = None):
+        error = None
+        for attempt in range(attempts or self.connect_attempts):
+            if attempt:
+                time.sleep(self.retry_delay)
+            start = time.perf_counter()
+            try:
+                print(f"Starting real serial on {self.serialport}")
+                self.get_lock()
+                port = self.serial_factory()
+                port.port = self.serialport
+                port.timeout = self.poll_interval if self.streaming else self.timeout
+                port.writeTimeout = self.timeout
+                port.baudrate = self.baud
+                port.open()
+                self.serial_port = port
+                self.connects += 1
+                self.connect_time = time.perf_counter() - start
+                print("serial opened")
+                return
+            except IOError as e:
+                self.release_lock()  # Make sure to release lock if serial fails
+                print("robot not connected?", e)
+                error = e
+        raise error
+
+    def _close_session(self):
+        self.stop_reader()
+        port, self.serial_port = self.serial_port, None
+        try:
+            if port is not None:
+                port.close()
+        except Exception as e:
+            print(f"Error closing serial: {e}", file=sys.stderr)
+        self.release_lock()
+
+    def _healthy(self) -> bool:
+        port = self.serial_port
+        if port is None or not getattr(port, 'is_open', True):
+            return False
+        try:
+            # Asks the driver, so fails once the USB device has gone away
+            getattr(port, 'in_waiting', None)
+        except Exception:
+            return False
+        return True
+
+    def _discard_input(self):
+        reset = getattr(self.serial_port, 'reset_input_buffer', None)
+        if reset is not None:
+            reset()
+
+    def _supervise(self):
+        while True:
+            time.sleep(self.health_interval)
+            with self._session_lock:
+                if self._in_block or self.serial_port is None:
+                    continue
+                if self.idle_timeout is not None and time.monotonic() - self._last_used > self.idle_timeout:
+                    if self.verbose:
+                        print(f"serial idle for {self.idle_timeout}s, closing")
+                    self.idle_closes += 1
+                    self._close_session()
+                elif not self._healthy():
+                    print(f"serial connection to {self.serialport} lost, reconnecting", file=sys.stderr)
+                    self.health_failures += 1
+                    self.reconnects += 1
+                    self._close_session()
+                    try:
+                        # Once only; if the bot is still missing the next block tries again
+                        self._connect(attempts=1)
+                    except IOError:
+                        pass
+
+    def metrics(self) -> dict:
+        with self._session_lock:
+            idle = self.serial_port is not None and not self._in_block
+            return {
+                'connected': self.serial_port is not None,
+                'in_block': self._in_block,
+                'idle_seconds': time.monotonic() - self._last_used if idle else None,
+                'blocks': self.blocks,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'health_failures': self.health_failures,
+                'idle_closes': self.idle_closes,
+                'connect_seconds': self.connect_time,
+            }
 
     def write_command(self, command: str) -> str:
         if self.verbose:
             print(f"-> {command}")
-        self.serial_port.write(str(command).encode('utf-8'))
-        return self.read_serial_response()
+        if self.streaming:
+            return self.stream_command(str(command))
+        return self._write_and_wait(str(command).encode('utf-8'))
+
+    def _write_and_wait(self, data: bytes) -> str:
+        stats = self.stats
+        try:
+            if stats is None:
+                self.serial_port.write(data)
+                return self.read_serial_response()
+            start = time.perf_counter()
+            self.serial_port.write(data)
+            written = time.perf_counter()
+            response = self.read_serial_response()
+        except Exception:
+            self._block_failed = True
+            raise
+        stats.record('serial.write', written - start)
+        stats.record('serial.wait_ok', time.perf_counter() - written)
+        return response
 
     def read_serial_response(self):
         response = ""
@@ -139,6 +384,145 @@ class SerialDrawbotOutput(DrawbotOutput):
             all_lines += response
         return all_lines
 
+    def start_reader(self):
+        """Reset the in-flight window, and start the thread matching "ok"s to commands if it isn't running.
+
+        The thread lasts as long as the session, so short blocks don't wait for it to stop.
+        """
+        with self._cond:
+            self._pending.clear()
+            self._completed = []
+            self._in_flight_bytes = 0
+            self._sequence = 0
+            self._error = None
+            self._failed = False
+        if self._reader is not None and self._reader.is_alive():
+            return
+        self._stop_reader.clear()
+        self._reader = threading.Thread(target=self._read_loop, name="drawbot-serial-reader", daemon=True)
+        self._reader.start()
+
+    def stop_reader(self):
+        if self._reader:
+            self._stop_reader.set()
+            self._reader.join(timeout=self.poll_interval * 10 + 1)
+            self._reader = None
+
+    def stream_command(self, command) -> str:
+        """Queue a command without waiting for its acknowledgement.
+
+        Blocks only while the in-flight window is full. Returns the responses of any
+        commands acknowledged since the last call, and raises a CommandError for a
+        command that failed or timed out earlier in the stream.
+        """
+        # Several commands can be in the firmware's buffer at once, so they must be line framed
+        data = (command + "\n").encode('utf-8')
+        stats = self.stats
+        start = time.perf_counter()
+        with self._cond:
+            self._wait_for_space(len(data))
+            self._sequence += 1
+            self._pending.append(_InFlightCommand(self._sequence, command, len(data)))
+            self._in_flight_bytes += len(data)
+        queued = time.perf_counter()
+        try:
+            self.serial_port.write(data)
+        except Exception as e:
+            self._fail(CommandError(f"Serial write failed: {e}", self._pending[-1].command, self._sequence))
+            self._raise_error()
+        if stats is not None:
+            stats.record('serial.window_wait', queued - start)
+            stats.record('serial.write', time.perf_counter() - queued)
+        with self._cond:
+            return self._take_completed()
+
+    def drain(self) -> str:
+        """Wait until every streamed command has been acknowledged"""
+        if not self.streaming or not self._reader:
+            return ""
+        with self._cond:
+            while self._pending and self._error is None and not self._failed:
+                self._cond.wait(self.poll_interval)
+            self._raise_error()
+            return self._take_completed()
+
+    def pending_count(self) -> int:
+        """Number of commands written but not yet acknowledged"""
+        with self._cond:
+            return len(self._pending)
+
+    def _wait_for_space(self, size: int):
+        while True:
+            self._raise_error()
+            if len(self._pending) < self.window and (
+                    self.buffer_bytes is None or not self._pending
+                    or self._in_flight_bytes + size <= self.buffer_bytes):
+                return
+            self._cond.wait(self.poll_interval)
+
+    def _take_completed(self) -> str:
+        completed = "".join(self._completed)
+        self._completed = []
+        return completed
+
+    def _raise_error(self):
+        # Report the failing command once, then refuse further commands like a closed port would
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            self._failed = True
+            raise error
+        if self._failed:
+            raise IOError("Serial stream stopped after an earlier error")
+
+    def _fail(self, error: CommandError):
+        with self._cond:
+            if self._error is None and not self._failed:
+                print(f"serial stream failed: {error}", file=sys.stderr)
+                self._error = error
+            self._cond.notify_all()
+
+    def _read_loop(self):
+        while not self._stop_reader.is_set():
+            try:
+                response = self.serial_port.readline().decode('utf-8')
+            except Exception as e:
+                head = self._pending[0] if self._pending else None
+                self._fail(CommandError(f"Serial read failed: {e}",
+                                        head.command if head else None,
+                                        head.sequence if head else None))
+                return
+            with self._cond:
+                if response:
+                    if self.verbose:
+                        print(f"<- {response}", end='')
+                    if not self._pending:
+                        if "ok" in response:
+                            # More "ok"s than commands, so earlier ones were credited to the wrong commands
+                            self._fail(CommandError("Serial acknowledgements out of step: ok with no command in flight"))
+                            return
+                        continue
+                    head = self._pending[0]
+                    head.response += response
+                    if "ok" in response:
+                        self._pending.popleft()
+                        self._in_flight_bytes -= head.size
+                        self._completed.append(head.response)
+                        self._cond.notify_all()
+                        stats = self.stats
+                        if stats is not None:
+                            # Time from write to "ok", the firmware's share of each command
+                            stats.record('serial.ack', time.perf_counter() - head.sent_perf)
+                if self._pending:
+                    # Each command times out from its own write: "ok"s carry no sequence number, so
+                    # one arriving for a later command must not extend the wait for a lost one
+                    head = self._pending[0]
+                    if time.time() - head.sent_at > self.timeout:
+                        print("timeout on serial read", file=sys.stderr)
+                        self._fail(CommandError(f"Serial timeout waiting for ok to command {head.sequence}: {head.command}",
+                                                head.command, head.sequence))
+                        return
+
     def start_file(self, filepath: str, setup: BotSetup):
         if self.verbose:
             print(f"Serial output starting file: {filepath}")
@@ -151,9 +535,18 @@ class SerialDrawbotOutput(DrawbotOutput):
 
 
 class FakeDrawbotOutput(DrawbotOutput):
-    def __init__(self, fake_delay=0.1, verbose=True):
+    def __init__(self, fake_delay=0.1, verbose=True, fail_after=None):
+        """
+        Args:
+            fake_delay: Seconds each command takes
+            verbose: Whether to print every command
+            fail_after: If set, commands after this many in a block time out like a
+                disconnected robot, until the next block starts
+        """
         self.fake_delay = fake_delay
         self.verbose = verbose
+        self.fail_after = fail_after
+        self.sent = 0
 
     def start_file(self, filepath: str, setup: BotSetup):
         if self.verbose:
@@ -168,6 +561,12 @@ class FakeDrawbotOutput(DrawbotOutput):
     def start_block(self):
         if self.verbose:
             print("Starting fake output")
+        self.sent = 0
+
+    def _check_failure(self):
+        if self.fail_after is not None and self.sent >= self.fail_after:
+            raise IOError("Serial timeout")
+        self.sent += 1
 
     def finish_block(self):
         if self.verbose:
@@ -176,12 +575,86 @@ class FakeDrawbotOutput(DrawbotOutput):
     def write_command(self, command: str) -> str:
         if self.verbose:
             print(f"Fake send -> {command}")
-        time.sleep(self.fake_delay)
+        self._check_failure()
+        if self.fake_delay:
+            time.sleep(self.fake_delay)
         return "fake ok"
 
 
+class _PreviewEncoder:
+    """Background thread that writes PNG previews so encoding never runs on the command thread.
+
+    It keeps its own copy of the image, updated from the dirty regions the drawing
+    thread hands over, and coalesces any patches that arrive while an encode runs.
+    """
+    def __init__(self, output_path: str, temp_path: str, compress_level: int, verbose=True):
+        self.output_path = output_path
+        self.temp_path = temp_path
+        self.compress_level = compress_level
+        self.verbose = verbose
+        self.image = None
+        self.last_encode_time = 0.0
+        self._cond = threading.Condition()
+        self._patches = []
+        self._busy = False
+        self._thread = threading.Thread(target=self._run, name="drawbot-png-encoder", daemon=True)
+        self._thread.start()
+
+    def submit(self, box, patch: Image.Image, reset=False):
+        """Queue a region to be pasted at box; reset replaces the whole image with patch"""
+        with self._cond:
+            if reset:
+                self._patches = []
+            self._patches.append((box, patch, reset))
+            self._cond.notify_all()
+
+    def flush(self, timeout=30):
+        """Wait until everything submitted so far has been written"""
+        with self._cond:
+            self._cond.wait_for(lambda: not self._patches and not self._busy, timeout)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._patches)
+                patches, self._patches = self._patches, []
+                self._busy = True
+            try:
+                for box, patch, reset in patches:
+                    if reset:
+                        self.image = patch
+                    elif self.image is not None:
+                        self.image.paste(patch, box)
+                if self.image is not None:
+                    start = time.time()
+                    self._save()
+                    self.last_encode_time = time.time() - start
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _save(self):
+        try:
+            # Save to temporary file first
+            self.image.save(self.temp_path, format='PNG', compress_level=self.compress_level)
+            # Then move the temporary file into place (atomic operation)
+            os.replace(self.temp_path, self.output_path)
+        except Exception as e:
+            print(f"Error saving PNG: {e}")
+            # Clean up temp file if it exists
+            try:
+                if os.path.exists(self.temp_path):
+                    os.remove(self.temp_path)
+            except:
+                pass
+
+
 class PNGOutput(DrawbotOutput):
-    def __init__(self, output_path, line_color=(0, 0, 0), bg_color=(220,220,190), line_width=2, verbose=True, scale=10, save_interval=10):
+    primary = False
+
+    def __init__(self, output_path, line_color=(0, 0, 0), bg_color=(220,220,190), line_width=2, verbose=True, scale=10,
+                 save_period=1.0, encode_budget=0.1, compress_level=1, max_size=None):
         """
         Initialize PNGOutput with a fixed output path.
         
@@ -192,7 +665,11 @@ class PNGOutput(DrawbotOutput):
             line_width: Width of drawn lines in pixels (default: 2)
             verbose: Whether to print debug information (default: True)
             scale: Factor to scale up the image dimensions (default: 10)
-            save_interval: Number of lines to draw before saving (default: 10)
+            save_period: Minimum seconds between saves of a changed image (default: 1.0)
+            encode_budget: Largest fraction of wall time spent encoding; slow encodes push
+                the next save further out (default: 0.1)
+            compress_level: zlib level for the PNG, low is much cheaper to encode (default: 1)
+            max_size: If set, reduce the scale so neither side exceeds this many pixels
         """
         self.output_path = output_path
         self.line_color = line_color
@@ -200,35 +677,45 @@ class PNGOutput(DrawbotOutput):
         self.line_width = line_width
         self.verbose = verbose
         self.scale = scale
-        self.save_interval = save_interval
+        self.save_period = save_period
+        self.encode_budget = encode_budget
+        self.compress_level = compress_level
+        self.max_size = max_size
         self.image = None
         self.draw = None
         self.current_pos = (0, 0)
         self.pen_down = False
         self.setup = None
-        self.lines_since_save = 0
+        self.image_scale = scale
+        self.dirty = None
+        self.next_save = 0
         
         # Create temp filename based on output path
         self.temp_path = output_path.replace(".png","_tmp.png")
         
         # Ensure the output directory exists
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        self.encoder = _PreviewEncoder(self.output_path, self.temp_path, compress_level, verbose)
 
     def start_file(self, filepath: str, setup: BotSetup):
         self.setup = setup
         
         # Create a new image with the drawable area dimensions
-        # Width is bot width minus margins, scaled up
-        width = (setup.bot_width - (2 * setup.x_margins)) * self.scale
-        # Height is bot height minus minimum_y_offset, scaled up
-        height = (setup.bot_height - setup.minimum_y_offset) * self.scale
+        # Width is bot width minus margins, height is bot height minus minimum_y_offset
+        area_width = setup.bot_width - (2 * setup.x_margins)
+        area_height = setup.bot_height - setup.minimum_y_offset
+        self.image_scale = self.scale
+        if self.max_size:
+            self.image_scale = min(self.scale, self.max_size / max(area_width, area_height, 1))
+        width = max(1, int(area_width * self.image_scale))
+        height = max(1, int(area_height * self.image_scale))
         
         if self.verbose:
             print(f"Creating PNG output of size {width}x{height}")
             print(f"Bot dimensions: {setup.bot_width}x{setup.bot_height}")
             print(f"X margins: {setup.x_margins}")
             print(f"Minimum Y offset: {setup.minimum_y_offset}")
-            print(f"Scale factor: {self.scale}")
+            print(f"Scale factor: {self.image_scale}")
             print(f"Output path: {self.output_path}")
             
         self.image = Image.new('RGB', (width, height), self.bg_color)
@@ -237,6 +724,7 @@ class PNGOutput(DrawbotOutput):
         # Initialize position to top-left of drawable area
         self.current_pos = (0, 0)
         self.pen_down = False
+        self.dirty = None
         
         # Save initial blank image
         self.save_image()
@@ -253,21 +741,27 @@ class PNGOutput(DrawbotOutput):
             self.draw = None
 
     def save_image(self):
-        """Save the current state of the image using atomic operations"""
+        """Write the whole current image and wait for it to be saved"""
         if self.image:
-            try:
-                # Save to temporary file first
-                self.image.save(self.temp_path)
-                # Then move the temporary file into place (atomic operation)
-                os.replace(self.temp_path, self.output_path)
-            except Exception as e:
-                print(f"Error saving PNG: {e}")
-                # Clean up temp file if it exists
-                try:
-                    if os.path.exists(self.temp_path):
-                        os.remove(self.temp_path)
-                except:
-                    pass
+            self.encoder.submit((0, 0), self.image.copy(), reset=True)
+            self.encoder.flush()
+            self.dirty = None
+            self.next_save = time.time() + self.save_period
+
+    def save_dirty(self):
+        """Hand the changed region to the encoder thread, if the time budget allows a save"""
+        now = time.time()
+        if self.dirty is None or now < self.next_save:
+            return
+        # Pad by the line width so line caps are included, and clip to the image
+        pad = self.line_width + 1
+        x0, y0, x1, y1 = self.dirty
+        box = (max(0, int(x0) - pad), max(0, int(y0) - pad),
+               min(self.image.width, int(x1) + pad + 1), min(self.image.height, int(y1) + pad + 1))
+        self.dirty = None
+        if box[0] < box[2] and box[1] < box[3]:
+            self.encoder.submit(box[:2], self.image.crop(box))
+        self.next_save = now + max(self.save_period, self.encoder.last_encode_time / self.encode_budget)
 
     def write_command(self, command: str) -> str:
         if not self.image or not self.draw:
@@ -282,30 +776,7 @@ class PNGOutput(DrawbotOutput):
                 coords = command[1:].split(',')
                 if len(coords) == 2:
                     # Convert from bot coordinates to image coordinates
-                    x = float(coords[0])
-                    y = float(coords[1])
-                    
-                    # Transform coordinates:
-                    # Subtract x_margin to move origin to drawable area
-                    # Subtract minimum_y_offset for y coordinate
-                    # Scale up by scale factor
-                    x = (x - self.setup.x_margins) * self.scale
-                    y = (y - self.setup.minimum_y_offset) * self.scale
-                    
-                    new_pos = (x, y)
-                    
-                    if self.pen_down:
-                        self.draw.line([self.current_pos, new_pos], 
-                                     fill=self.line_color, 
-                                     width=self.line_width)
-                        self.lines_since_save += 1
-                        
-                        # Save periodically based on save_interval
-                        if self.lines_since_save >= self.save_interval:
-                            self.save_image()
-                            self.lines_since_save = 0
-                    
-                    self.current_pos = new_pos
+                    self.move_to(float(coords[0]), float(coords[1]))
             
             return "png ok"
             
@@ -314,100 +785,797 @@ class PNGOutput(DrawbotOutput):
                 print(f"Error processing command {command}: {e}")
             return "png error"
 
+    def write_commands(self, commands: list):
+        """Draw a chunk of commands as one polyline per stroke instead of a line per move"""
+        if not self.image or not self.draw:
+            return
+        count = len(commands)
+        op = np.empty(count, dtype=np.int8)
+        x = np.empty(count)
+        y = np.empty(count)
+        for i, command in enumerate(commands):
+            op[i], x[i], y[i] = drawbot_gcode.parse_command(command.strip())
+        origin = np.array([self.setup.x_margins, self.setup.minimum_y_offset])
+        start = np.array(self.current_pos) / self.image_scale + origin
+        strokes = drawbot_thumbnails.stroke_polylines(op, x, y, start=start, pen_down=self.pen_down)
+        if strokes:
+            drawbot_thumbnails.draw_strokes(self.draw, strokes, origin, self.image_scale,
+                                            self.line_color, self.line_width)
+            points = (np.concatenate(strokes) - origin) * self.image_scale
+            low, high = points.min(axis=0), points.max(axis=0)
+            self.mark_dirty(low.tolist(), high.tolist())
+            self.save_dirty()
+        # Leave the pen and position where the last commands put them
+        pens = np.flatnonzero(op == OP_PEN)
+        if len(pens):
+            self.pen_down = bool(x[pens[-1]] == 1)
+        moves = np.flatnonzero(op == OP_MOVE)
+        if len(moves):
+            last = moves[-1]
+            self.current_pos = (float((x[last] - origin[0]) * self.image_scale),
+                                float((y[last] - origin[1]) * self.image_scale))
+
+    def move_to(self, x: float, y: float):
+        # Transform coordinates:
+        # Subtract x_margin to move origin to drawable area
+        # Subtract minimum_y_offset for y coordinate
+        # Scale up by scale factor
+        x = (x - self.setup.x_margins) * self.image_scale
+        y = (y - self.setup.minimum_y_offset) * self.image_scale
+        
+        new_pos = (x, y)
+        
+        if self.pen_down:
+            self.draw.line([self.current_pos, new_pos], 
+                         fill=self.line_color, 
+                         width=self.line_width)
+            self.mark_dirty(self.current_pos, new_pos)
+            self.save_dirty()
+        
+        self.current_pos = new_pos
+
+    def mark_dirty(self, a, b):
+        x0, x1 = min(a[0], b[0]), max(a[0], b[0])
+        y0, y1 = min(a[1], b[1]), max(a[1], b[1])
+        if self.dirty is None:
+            self.dirty = (x0, y0, x1, y1)
+        else:
+            d = self.dirty
+            self.dirty = (min(d[0], x0), min(d[1], y0), max(d[2], x1), max(d[3], y1))
+
+
+class StrokeLogOutput(DrawbotOutput):
+    """Appends the strokes actually drawn to a compact, append-only polyline log.
+
+    Each point is a little-endian float32 record (x, y, flag) in bot coordinates,
+    where flag 0 starts a new polyline and 1 continues the current one. A JSON
+    sidecar holds the drawable area and a generation id that changes with every
+    file, so clients can fetch just the records after the last offset they saw.
+    """
+    RECORD = struct.Struct('<fff')
+    primary = False
+
+    def __init__(self, log_path, flush_interval=0.5, verbose=True):
+        """
+        Args:
+            log_path: Path of the binary log; the sidecar is the same path with .json
+            flush_interval: Seconds between writes of buffered records to disk
+            verbose: Whether to print debug information
+        """
+        self.log_path = log_path
+        self.meta_path = os.path.splitext(log_path)[0] + ".json"
+        self.flush_interval = flush_interval
+        self.verbose = verbose
+        self.log_file = None
+        self.buffer = bytearray()
+        self.last_flush = 0
+        self.current_pos = None
+        self.pen_down = False
+        self.in_stroke = False
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+
+    def start_file(self, filepath: str, setup: BotSetup):
+        meta = {
+            'generation': f"{time.time():.6f}",
+            'file': filepath,
+            'x_margins': setup.x_margins,
+            'minimum_y_offset': setup.minimum_y_offset,
+            'width': setup.bot_width - (2 * setup.x_margins),
+            'height': setup.bot_height - setup.minimum_y_offset,
+        }
+        self.log_file = open(self.log_path, 'wb')
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+        self.buffer = bytearray()
+        self.last_flush = time.time()
+        self.current_pos = None
+        self.pen_down = False
+        self.in_stroke = False
+        if self.verbose:
+            print(f"Stroke log started at {self.log_path}, generation {meta['generation']}")
+
+    def end_file(self, filepath: str, success: bool):
+        if self.log_file:
+            self.flush()
+            self.log_file.close()
+            self.log_file = None
+
+    def finish_block(self):
+        self.flush()
+
+    def flush(self):
+        if self.log_file and self.buffer:
+            self.log_file.write(self.buffer)
+            self.log_file.flush()
+            self.buffer = bytearray()
+        self.last_flush = time.time()
+
+    def write_command(self, command: str) -> str:
+        if not self.log_file:
+            return "log ok"
+        if command.startswith('d'):
+            self.set_pen(command == 'd1')
+        elif command.startswith('g'):
+            coords = command[1:].split(',')
+            if len(coords) == 2:
+                try:
+                    self.move_to(float(coords[0]), float(coords[1]))
+                except ValueError:
+                    return "log error"
+        return "log ok"
+
+    def set_pen(self, down: bool):
+        self.pen_down = down
+        self.in_stroke = False
+
+    def move_to(self, x: float, y: float):
+        if self.pen_down and self.current_pos is not None:
+            if not self.in_stroke:
+                self.buffer += self.RECORD.pack(self.current_pos[0], self.current_pos[1], 0)
+                self.in_stroke = True
+            self.buffer += self.RECORD.pack(x, y, 1)
+        self.current_pos = (x, y)
+        if time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+
+def read_stroke_log(log_path: str, offset: int = 0, limit: int = None):
+    """Read the log sidecar and the point records from offset onwards.
+
+    Returns (meta, offset, points) where offset is clamped to the records available
+    and points is an (n, 3) float32 array of x, y, flag. Only whole records are
+    returned, so a reader never sees a half-written point.
+    """
+    meta_path = os.path.splitext(log_path)[0] + ".json"
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, 0, np.zeros((0, 3), dtype=np.float32)
+    record_size = StrokeLogOutput.RECORD.size
+    try:
+        available = os.path.getsize(log_path) // record_size
+    except OSError:
+        available = 0
+    offset = min(max(0, offset), available)
+    count = available - offset
+    if limit is not None:
+        count = min(count, limit)
+    if count <= 0:
+        return meta, offset, np.zeros((0, 3), dtype=np.float32)
+    points = np.fromfile(log_path, dtype='<f4', count=count * 3, offset=offset * record_size)
+    return meta, offset, points.reshape(-1, 3)
+
+
+def render_stroke_log(log_path: str, max_size=1024, line_color=(0, 0, 0), bg_color=(220,220,190), line_width=2):
+    """Rasterize the whole stroke log on demand, one polyline per stroke"""
+    meta, _, points = read_stroke_log(log_path)
+    if meta is None:
+        return None
+    scale = max_size / max(meta['width'], meta['height'], 1)
+    image = Image.new('RGB', (max(1, int(meta['width'] * scale)), max(1, int(meta['height'] * scale))), bg_color)
+    draw = ImageDraw.Draw(image)
+    xy = np.empty((len(points), 2))
+    xy[:, 0] = (points[:, 0] - meta['x_margins']) * scale
+    xy[:, 1] = (points[:, 1] - meta['minimum_y_offset']) * scale
+    starts = np.flatnonzero(points[:, 2] == 0).tolist() + [len(points)]
+    for a, b in zip(starts[:-1], starts[1:]):
+        draw.line(xy[a:b].ravel().tolist(), fill=line_color, width=line_width)
+    return image
+
+
+class ListenerDispatcher:
+    """Delivers state listener notifications on a dedicated thread.
+
+    The send loop only enqueues, so a slow listener (e.g. an MQTT broker that is
+    reconnecting) can't stall pen motion. Only the latest progress and time-left
+    values matter, so a newer one replaces any still waiting; state transitions are
+    always delivered, in order.
+    """
+    COALESCED = ('set_progress', 'set_estimated_time_left')
+
+    def __init__(self, listeners: List[StateListener]):
+        self.listeners = listeners
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._waiting = {}
+        self._busy = False
+        self.dispatched = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = 0.0
+        self.stats = None
+        self._thread = threading.Thread(target=self._run, name="drawbot-listeners", daemon=True)
+        self._thread.start()
+
+    def submit(self, method: str, *args):
+        entry = [method, args, time.time()]
+        with self._cond:
+            if method in self.COALESCED:
+                previous = self._waiting.get(method)
+                if previous is not None:
+                    # Superseded before it was delivered; cancel it and send the new value in order
+                    previous[0] = None
+                    self.coalesced += 1
+                self._waiting[method] = entry
+            self._queue.append(entry)
+            self._cond.notify_all()
+
+    def flush(self, timeout=10):
+        """Wait until every queued notification has been delivered"""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                'dispatched': self.dispatched,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'queued': len(self._queue),
+                'latency_avg': self.latency_total / self.dispatched if self.dispatched else 0.0,
+                'latency_max': self.latency_max,
+                'latency_last': self.latency_last,
+            }
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue)
+                method, args, queued_at = entry = self._queue.popleft()
+                if method is None:
+                    continue
+                if self._waiting.get(method) is entry:
+                    del self._waiting[method]
+                self._busy = True
+            stats = self.stats
+            try:
+                for listener in list(self.listeners):
+                    start = time.perf_counter()
+                    try:
+                        getattr(listener, method)(*args)
+                    except Exception as e:
+                        self.errors += 1
+                        print(f"Error in {method} for {type(listener).__name__}: {e}")
+                    if stats is not None:
+                        stats.record(f"listener.{type(listener).__name__}.{method}", time.perf_counter() - start)
+            finally:
+                latency = time.time() - queued_at
+                if stats is not None:
+                    stats.record('listener.delivery', latency)
+                with self._cond:
+                    self._busy = False
+                    self.dispatched += 1
+                    self.latency_total += latency
+                    self.latency_max = max(self.latency_max, latency)
+                    self.latency_last = latency
+                    self._cond.notify_all()
+
+
+class SecondaryOutputFeed:
+    """Feeds a secondary output from its own thread, so it never slows down the bot.
+
+    Commands are handed over in chunks of chunk_size through a queue of at most
+    max_chunks chunks. When the output has caught up, the thread also takes the
+    partly filled chunk once its first command is max_delay seconds old, so the
+    output lags the bot by that much rather than by a chunk of commands, however
+    slowly the bot goes. When the output falls max_chunks behind, the new chunk is
+    folded into the newest waiting one, and together they are replaced by the few
+    commands that leave the output in the same state: pen up, travel to the last
+    position, pen as it ended. The preview loses those strokes but never gains a
+    line that wasn't drawn. Calls such as start_file are queued in order with the
+    commands and never dropped.
+    """
+    def __init__(self, output: DrawbotOutput, name: str, chunk_size=256, max_chunks=64, max_delay=0.1):
+        self.output = output
+        self.name = name
+        self.chunk_size = chunk_size
+        self.max_chunks = max_chunks
+        self.max_delay = max_delay
+        # RunStats to time chunks into, set by send_block
+        self.stats = None
+        self.chunk = []
+        self._chunk_started = 0.0
+        self.pen_down = False
+        self.commands = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.max_waiting = 0
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._waiting_chunks = 0
+        self._busy = False
+        self._thread = threading.Thread(target=self._run, name=f"drawbot-{name}", daemon=True)
+        self._thread.start()
+
+    def write(self, command):
+        """Queue a command; only called from the send loop"""
+        with self._cond:
+            if not self.chunk:
+                # Starts the thread's max_delay clock for this chunk
+                self._chunk_started = time.perf_counter()
+                self._cond.notify_all()
+            self.chunk.append(command)
+            # The pen state is all a coalesced chunk needs that its commands may not say
+            if command[:1] == 'd':
+                self.pen_down = command.strip() == 'd1'
+            if len(self.chunk) >= self.chunk_size:
+                self._push_chunk()
+                self._cond.notify_all()
+
+    def call(self, method: str, *args):
+        """Queue a call to the output after every command written so far"""
+        with self._cond:
+            self._push_chunk()
+            self._queue.append((method, args))
+            self._cond.notify_all()
+
+    def push(self):
+        """Hand over the partly filled chunk"""
+        with self._cond:
+            self._push_chunk()
+            self._cond.notify_all()
+
+    def flush(self, timeout=30) -> bool:
+        """Wait until the output has caught up; returns False on timeout"""
+        with self._cond:
+            self._push_chunk()
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: not self._queue and not self._busy, timeout)
+
+    def _push_chunk(self):
+        if not self.chunk:
+            return
+        chunk, self.chunk = self.chunk, []
+        self.commands += len(chunk)
+        if self._waiting_chunks >= self.max_chunks and self._queue[-1][0] == 'write':
+            previous = self._queue[-1][1][0]
+            merged = self._collapse(previous + chunk)
+            self.coalesced += len(previous) + len(chunk) - len(merged)
+            self._queue[-1] = ('write', (merged,))
+            return
+        self._queue.append(('write', (chunk,)))
+        self._waiting_chunks += 1
+        self.max_waiting = max(self.max_waiting, self._waiting_chunks)
+
+    def _collapse(self, commands: list) -> list:
+        position = None
+        for command in reversed(commands):
+            op, x, y = drawbot_gcode.parse_command(command)
+            if op == OP_MOVE:
+                position = (x, y)
+                break
+        collapsed = ["d0"]
+        if position is not None:
+            collapsed.append(f"g{round(position[0], 2):g},{round(position[1], 2):g}")
+        if self.pen_down:
+            collapsed.append("d1")
+        return collapsed
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    if self.chunk:
+                        waited = time.perf_counter() - self._chunk_started
+                        if waited >= self.max_delay:
+                            # Caught up, so don't leave the latest commands waiting for a full chunk
+                            self._push_chunk()
+                            continue
+                        self._cond.wait(self.max_delay - waited)
+                    else:
+                        self._cond.wait()
+                method, args = self._queue.popleft()
+                if method == 'write':
+                    self._waiting_chunks -= 1
+                self._busy = True
+            start = time.perf_counter()
+            try:
+                if method == 'write':
+                    self.output.write_commands(*args)
+                else:
+                    getattr(self.output, method)(*args)
+            except Exception as e:
+                self.errors += 1
+                print(f"Error in {self.name} {method}: {e}")
+            finally:
+                stats = self.stats
+                if stats is not None and method == 'write':
+                    stats.record(self.name, time.perf_counter() - start)
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                'commands': self.commands,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'waiting_chunks': self._waiting_chunks,
+                'max_waiting_chunks': self.max_waiting,
+            }
+
+
+# Commands the control channel sends, and the most the bot can be asked to do mid-drawing
+CONTROL_COMMANDS = {'pen_up': "d0", 'pen_down': "d1", 'home': "g380,250"}
+
 
 class DrawbotControl:
-    def __init__(self, outputs: List[DrawbotOutput], verbose=True):
+    def __init__(self, outputs: List[DrawbotOutput], verbose=True, motion_model: MotionModel = None,
+                 name: str = None):
         self.outputs = outputs
+        # Which bot this is when one server drives several, saved with checkpoints
+        self.name = name
         self.verbose = verbose
+        self.motion_model = motion_model
         self.proportion = 1.0
         self.state_listeners = []
+        self.dispatcher = ListenerDispatcher(self.state_listeners)
+        self.run_stats = None
+        self.state = "idle"
+        # Control channel: requests for the block being sent, checked between its commands
+        self._channel = threading.Condition()
+        self._requests = deque()
+        self._block_active = False
+        self._paused = False
+        self.feeds = {}
+        for output, name in zip(outputs, self._output_names()):
+            if not output.primary:
+                self.feeds[output] = SecondaryOutputFeed(output, name)
 
     def add_state_listener(self,listener:StateListener):
         self.state_listeners.append(listener)
     
     def send_state(self,state:str):
-        try:
-            for listener in self.state_listeners:
-                listener.set_state(state)
-        except Exception as e:
-            print(f"Error sending state: {e}")
+        self.state = state
+        self.dispatcher.submit('set_state', state)
 
     def send_progress(self,progress:float,done:int,total:int):
-        try:
-            for listener in self.state_listeners:
-                listener.set_progress(progress,done,total)
-        except Exception as e:
-            print(f"Error sending progress: {e}")
+        self.dispatcher.submit('set_progress', progress, done, total)
 
     def send_estimated_time_left(self,time_left:float):
+        self.dispatcher.submit('set_estimated_time_left', time_left)
+
+    def dispatch_metrics(self) -> dict:
+        """Latency and coalescing counters for state listener notifications"""
+        return self.dispatcher.metrics()
+
+    def run_metrics(self) -> Optional[dict]:
+        """Timing summary of the block being sent, or of the last one sent"""
+        return self.run_stats.summary() if self.run_stats else None
+
+    def output_metrics(self) -> dict:
+        """Backlog and coalescing counters for each secondary output"""
+        return {feed.name: feed.metrics() for feed in self.feeds.values()}
+
+    def flush_outputs(self, timeout=30) -> bool:
+        """Wait for the secondary outputs to catch up with everything sent"""
+        return all([feed.flush(timeout) for feed in self.feeds.values()])
+
+    def _each_output(self, method: str, *args):
+        # Secondary outputs get the call in order with the commands already queued for them
+        for output in self.outputs:
+            feed = self.feeds.get(output)
+            if feed is not None:
+                feed.call(method, *args)
+            else:
+                getattr(output, method)(*args)
+
+    def _output_names(self) -> List[str]:
+        # Stage names per output, numbered when the same output type is used twice
+        names = [type(output).__name__ for output in self.outputs]
+        return [f"output.{name}" if names.count(name) == 1 else f"output.{name}.{i}"
+                for i, name in enumerate(names)]
+
+    @property
+    def paused(self) -> bool:
+        return self._paused
+
+    def control(self, command: str) -> bool:
+        """Carry out pen_up, pen_down, home, pause, resume or stop now, ahead of any queued job
+
+        While a block is being sent the command goes in between two of its commands, so it
+        waits at most for the command being sent, plus those in flight when streaming.
+        pen_down and home are only taken while paused, where they can't spoil the drawing.
+        With no block being sent, pen_up, pen_down and home are sent on the calling thread.
+
+        Returns:
+            Whether the command was taken
+        """
+        with self._channel:
+            if self._block_active:
+                if command in ('pen_down', 'home', 'resume') and not self._paused:
+                    return False
+                if command not in CONTROL_COMMANDS and command not in ('pause', 'resume', 'stop'):
+                    return False
+                self._requests.append(command)
+                self._channel.notify_all()
+                return True
+            if command not in CONTROL_COMMANDS:
+                return False
+            self._block_active = True
         try:
-            for listener in self.state_listeners:
-                listener.set_estimated_time_left(time_left)
-        except Exception as e:
-            print(f"Error sending estimated time left: {e}")
+            self._send_block([CONTROL_COMMANDS[command]])
+        finally:
+            self._end_block()
+        return True
+
+    def _begin_block(self):
+        with self._channel:
+            # A control command sent straight from control() takes milliseconds
+            self._channel.wait_for(lambda: not self._block_active)
+            self._block_active = True
+
+    def _end_block(self):
+        with self._channel:
+            self._block_active = False
+            self._paused = False
+            # Anything left is covered by the pen up every block ends with
+            self._requests.clear()
+            self._channel.notify_all()
+
+    def _serve_controls(self, outputs, feeds, cancel_event, checkpoint, sent: int):
+        """Carry out the control requests waiting
+
+        Args:
+            sent: Number of block commands sent so far
+
+        Returns:
+            The responses, whether to stop the block, and the seconds spent paused
+        """
+        response = ""
+        resume_to = None
+        paused_at = None
+        paused = 0.0
+        while True:
+            with self._channel:
+                if not self._requests:
+                    if not self._paused:
+                        return response, False, paused
+                    self._channel.wait(0.5)
+                    if cancel_event and cancel_event.is_set():
+                        return response, True, paused + time.time() - paused_at
+                    continue
+                command = self._requests.popleft()
+            if command == 'stop':
+                return response, True, paused + (time.time() - paused_at if self._paused else 0.0)
+            if command == 'pause' and not self._paused:
+                print("Pausing")
+                # Let everything sent be drawn, so the checkpoint is exact while the bot waits
+                for output, _ in outputs:
+                    response += output.drain()
+                if checkpoint is not None:
+                    checkpoint.save(sent)
+                    resume_to = (checkpoint.pen_down, checkpoint.position)
+                resume_state = self.state
+                paused_at = time.time()
+                self._paused = True
+                response += self._write_control("d0", outputs, feeds)
+                # Show everything drawn so far while the bot waits
+                for feed in feeds:
+                    feed.push()
+                self.send_state("paused")
+            elif command == 'resume' and self._paused:
+                print("Resuming")
+                paused += time.time() - paused_at
+                if resume_to is not None:
+                    # Back to where the drawing stopped with the pen up, then the pen as it was
+                    pen_down, position = resume_to
+                    response += self._write_control("d0", outputs, feeds)
+                    response += self._write_control(f"g{round(position[0], 2):g},{round(position[1], 2):g}",
+                                                    outputs, feeds)
+                    if pen_down:
+                        response += self._write_control("d1", outputs, feeds)
+                with self._channel:
+                    self._paused = False
+                self.send_state(resume_state)
+            elif command in CONTROL_COMMANDS:
+                response += self._write_control(CONTROL_COMMANDS[command], outputs, feeds)
+
+    @staticmethod
+    def _write_control(command: str, outputs, feeds) -> str:
+        response = ""
+        for output, _ in outputs:
+            response += output.write_command(command)
+        for feed in feeds:
+            feed.write(command)
+        return response
 
     def start_serial(self):
-        for output in self.outputs:
-            output.start_block()
+        self._each_output('start_block')
 
     def finish_serial(self):
-        for output in self.outputs:
-            output.finish_block()
+        self._each_output('finish_block')
 
-    def send_block(self, commands:list[str], cancel_event=None):
+    def send_block(self, commands:Iterable[str], cancel_event=None, total:int=None, name:str=None,
+                   estimator:TimeEstimator=None, checkpoint:Checkpoint=None):
+        """
+        Send a sequence of commands to all outputs.
+
+        Every stage of the loop is timed into a RunStats, kept as run_stats until the
+        next block starts. Primary outputs are written in turn for each command;
+        secondary ones are only handed the command, see SecondaryOutputFeed. Requests
+        made through control() are carried out between commands; while paused the
+        block waits, and on resume returns to where the checkpoint says it stopped.
+
+        Args:
+            commands: Commands to send; may be a lazy iterator
+            cancel_event: Optional event to cancel execution
+            total: Number of commands, used for progress when commands has no len()
+            name: Label for the run statistics, e.g. the file being drawn
+            estimator: Optional motion model estimate for the time left; without one the
+                time left assumes every command takes as long as the average so far
+            checkpoint: Optional Checkpoint kept up to date with the last acknowledged command
+        """
+        self._begin_block()
+        try:
+            return self._send_block(commands, cancel_event, total, name, estimator, checkpoint)
+        finally:
+            self._end_block()
+
+    def _send_block(self, commands, cancel_event=None, total=None, name=None, estimator=None, checkpoint=None):
+        num_commands = total if total is not None else len(commands)
         if self.verbose:
-            print(f"Sending {len(commands)} commands")
+            print(f"Sending {num_commands} commands")
+
+        stats = self.run_stats = RunStats(name)
+        outputs = [(output, stage) for output, stage in zip(self.outputs, self._output_names())
+                   if output not in self.feeds]
+        primaries = [output for output, _ in outputs]
+        feeds = list(self.feeds.values())
+        for output in primaries:
+            output.stats = stats
+        for feed in feeds:
+            feed.stats = stats
+        self.dispatcher.stats = stats
+        perf_counter = time.perf_counter
         
-        for output in self.outputs:
-            output.start_block()
+        self._each_output('start_block')
             
         comment_match = re.compile("^#")
+        requests = self._requests
         response = ""
-        num_commands = len(commands)
         last_proportion = 0
         last_update = time.time()
         start_time = time.time()
         self.send_progress(last_proportion,0,num_commands)
-        self.send_estimated_time_left(num_commands)
+        self.send_estimated_time_left(estimator.total if estimator else num_commands)
+        sent = 0
+        next_index = 0
+        result = "completed"
         
         for i, line in enumerate(commands):
             try:
+                command_start = perf_counter()
                 if self.verbose and i % 100 == 0:
                     command_rate = i / (time.time() - start_time)
                     print(f"Sending command {i} of {num_commands}: {line} ({self.proportion}) (at {command_rate} commands/second)")
-                if cancel_event and cancel_event.is_set():
+                cancelled = cancel_event and cancel_event.is_set()
+                stage_start = perf_counter()
+                stats.record('cancel_check', stage_start - command_start)
+                if requests:
+                    served, stop, paused = self._serve_controls(outputs, feeds, cancel_event, checkpoint,
+                                                                next_index)
+                    response += served
+                    cancelled = cancelled or stop
+                    # Time spent paused counts towards neither the run nor the time left
+                    stats.paused += paused
+                    start_time += paused
+                    now = perf_counter()
+                    stats.record('control', now - stage_start)
+                    stage_start = command_start = now
+                if cancelled:
                     self.do_stop()
                     print("Cancel event set, stopping execution and raising pen")
+                    result = "cancelled"
                     break
                     
-                self.proportion = i / num_commands
+                self.proportion = i / num_commands if num_commands else 1.0
                 if abs(self.proportion - last_proportion) > 0.01 or time.time() - last_update > 30:
                     self.send_progress(round(self.proportion*100, 0),i,num_commands)
                     last_proportion = self.proportion
                     last_update = time.time()
-                    time_remaining = (time.time() - start_time) * (1 - self.proportion) / self.proportion
-                    self.send_estimated_time_left(time_remaining)
+                    if estimator is not None:
+                        self.send_estimated_time_left(estimator.remaining(i, time.time() - start_time))
+                    elif self.proportion > 0:
+                        time_remaining = (time.time() - start_time) * (1 - self.proportion) / self.proportion
+                        self.send_estimated_time_left(time_remaining)
+                    stats.record('progress', perf_counter() - stage_start)
 
                 if comment_match.match(line):
                     print(f"skipping line: {line}")
+                    continue
                 elif line is not None:
-                    for output in self.outputs:
+                    for output, stage in outputs:
+                        stage_start = perf_counter()
                         response += output.write_command(line)
+                        stats.record(stage, perf_counter() - stage_start)
+                if line is not None:
+                    for feed in feeds:
+                        feed.write(line)
+                sent += 1
+                next_index = i + 1
+                if checkpoint is not None:
+                    checkpoint.sent(i, line)
+                    if command_start >= checkpoint.next_save:
+                        checkpoint.save(next_index - self.pending_count())
+                stats.record('command', perf_counter() - command_start)
                         
+            except CommandError as e:
+                # With a streaming output this may be an earlier command that failed
+                print(f"Error sending command {i}: {e} (command {e.sequence} of block: {e.command})")
+                result = self._command_failed(checkpoint, i)
             except Exception as e:
                 print(f"Error sending command {i}: {e}")
+                result = self._command_failed(checkpoint, i)
                 
         self.do_stop()
-        for output in self.outputs:
-            output.finish_block()
+        drain_start = perf_counter()
+        for output in primaries:
+            try:
+                response += output.drain()
+            except CommandError as e:
+                print(f"Error completing commands: {e} (command {e.sequence} of block: {e.command})")
+                result = self._command_failed(checkpoint, next_index)
+            except Exception as e:
+                print(f"Error completing commands: {e}")
+                result = self._command_failed(checkpoint, next_index)
+        stats.record('drain', perf_counter() - drain_start)
+        if checkpoint is not None:
+            # Everything sent has now been acknowledged, unless a failure froze the checkpoint
+            checkpoint.save(next_index)
+        self._each_output('finish_block')
+        for output in primaries:
+            output.stats = None
+        # The dispatcher keeps recording into this run until the next block replaces it,
+        # so notifications still queued at the end are not lost from the live metrics
+        stats.finish(sent, result)
             
         if self.verbose:
-            print(f"Finished sending {len(commands)} commands")
+            print(f"Finished sending {num_commands} commands")
         return response
 
-    def send_file(self, filepath: str, setup:BotSetup, cancel_event=None, raise_pen_after=True, home_after=True):
+    def pending_count(self) -> int:
+        return max((output.pending_count() for output in self.outputs if output not in self.feeds), default=0)
+
+    def _command_failed(self, checkpoint, index: int) -> str:
+        # Commands from index on may not have reached the bot; a resume starts from before them
+        if checkpoint is not None and not checkpoint.frozen:
+            checkpoint.freeze(index - self.pending_count())
+        return "failed"
+
+    def send_file(self, filepath: str, setup:BotSetup, cancel_event=None, raise_pen_after=True, home_after=True,
+                  resume=False):
         """
         Send commands from a file to the drawbot.
+
+        Progress is checkpointed to checkpoint.json next to the file, and removed once
+        the whole file has been drawn.
         
         Args:
             filepath: Path to the file containing commands
@@ -415,6 +1583,12 @@ class DrawbotControl:
             cancel_event: Optional event to cancel execution
             raise_pen_after: Whether to raise the pen after execution (default: True)
             home_after: Whether to home the drawbot after execution (default: True)
+            resume: Continue from the saved checkpoint instead of the start, travelling
+                there with the pen up first
+
+        Raises:
+            CommandError: The bot stopped acknowledging commands; the checkpoint is kept so
+                the drawing can be resumed
         """
         print(f"send_file: {filepath}")
         success = False
@@ -425,24 +1599,61 @@ class DrawbotControl:
             self.send_state(f"drawing {fp}")
             
             # Notify outputs that we're starting a file
-            for output in self.outputs:
-                output.start_file(filepath, setup)
+            self._each_output('start_file', filepath, setup)
 
-            with open(filepath) as f:
-                commands = f.readlines()
-            
-            # Strip whitespace and filter out empty lines
-            commands = [cmd.strip() for cmd in commands if cmd.strip()]
-            
             # Add safety commands
-            final_commands = ["d0"]  # Start with pen up
-            final_commands.extend(commands)
+            prologue = ["d0"]  # Start with pen up
+            epilogue = []
             if raise_pen_after:
-                final_commands.append("d0")
+                epilogue.append("d0")
             if home_after:
-                final_commands.append("g380,250")
+                epilogue.append("g380,250")
+
+            num_commands = drawbot_gcode.count_commands(filepath)
+            fingerprint = file_fingerprint(filepath, num_commands)
+            start = 0
+            pen_down, position = False, (380.0, 250.0)
+            if resume:
+                saved = load_checkpoint(filepath, fingerprint)
+                if saved is None:
+                    raise ValueError(f"No checkpoint to resume {filepath} from")
+                start, pen_down, position = saved['index'], saved['pen_down'], tuple(saved['position'])
+                print(f"Resuming {filepath} from command {start} of {num_commands}")
+                # Travel to where the drawing stopped with the pen up, then put the pen back as it was
+                prologue = ["d0", f"g{round(position[0], 2):g},{round(position[1], 2):g}"]
+                if pen_down:
+                    prologue.append("d1")
+            checkpoint = Checkpoint(filepath, fingerprint, start, len(prologue), pen_down, position, bot=self.name)
+
+            estimator = None
+            features = None
+            if self.motion_model is not None:
+                # Per-command times for the estimate, from the commands still to draw
+                records = drawbot_gcode.parse_file(filepath)[start:]
+                features = self._block_features(prologue, records, epilogue, setup)
+                estimator = TimeEstimator(self.motion_model.command_costs(features))
+            # Stream the file rather than loading it; the count comes from the sidecar index or a pre-scan
+            commands = islice(drawbot_gcode.read_commands(filepath), start, None)
+            final_commands = chain(prologue, commands, epilogue)
                 
-            output = self.send_block(final_commands, cancel_event)
+            try:
+                output = self.send_block(final_commands, cancel_event,
+                                         total=len(prologue) + num_commands - start + len(epilogue), name=fp,
+                                         estimator=estimator, checkpoint=checkpoint)
+                if self.run_stats.result == "completed":
+                    clear_checkpoint(filepath)
+                if features is not None and self.run_stats.result == "completed":
+                    # Every completed drawing refines the time model for the next estimate
+                    self.motion_model.observe(dict(zip(drawbot_motion.FEATURES, features.sum(axis=0).tolist())),
+                                              self.run_stats.summary()['elapsed'])
+                    self.motion_model.save()
+            finally:
+                if self.run_stats is not None:
+                    # Kept next to the drawing so the design page can show where the time went
+                    self.run_stats.write(os.path.join(os.path.dirname(filepath), 'run_stats.json'))
+            if self.run_stats is not None and self.run_stats.result == "failed":
+                # Fails the job instead of recording it done, so the page offers Resume
+                raise CommandError(f"Drawing {fp} failed after {self.run_stats.commands} commands")
             print("Finished send_file")
             self.send_state("idle")
             success = True
@@ -455,13 +1666,22 @@ class DrawbotControl:
             
         finally:
             # Notify outputs that we're done with the file
-            for output in self.outputs:
-                output.end_file(filepath, success)
+            self._each_output('end_file', filepath, success)
+
+    @staticmethod
+    def _block_features(prologue, records, epilogue, setup):
+        records = np.concatenate((drawbot_gcode.parse_commands(prologue), records,
+                                  drawbot_gcode.parse_commands(epilogue)))
+        return drawbot_motion.command_features(records['op'], records['x'], records['y'], setup)
 
     def do_stop(self):
         try:
             for output in self.outputs:
-                output.write_command("d0")
+                feed = self.feeds.get(output)
+                if feed is not None:
+                    feed.write("d0")
+                else:
+                    output.write_command("d0")
         except Exception as e:
             print(f"Error stopping drawbot: {e}")
         try:    
@@ -0,0 +1,106 @@
+# SVG to g-code conversion for uploaded drawings.
+# Kept free of import side effects (no serial, MQTT or Flask setup) so it can run
+# in the conversion process pool without dragging the server along.
+
+import json
+import os
+import time
+
+from drawbot_converter.transformer_svgpathtools import TransformerSVGPathTools
+from drawbot_converter.bot_setup import BotSetup
+
+import drawbot_gcode
+import drawbot_motion
+import drawbot_paths
+import drawbot_thumbnails
+from drawbot_cache import ConversionCache
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+UPLOAD_FOLDER = 'data/uploaded'
+# Points closer than this (mm) to the simplified stroke are dropped before drawing
+DEFAULT_SIMPLIFY_TOLERANCE = 0.1
+
+_cache = None
+
+
+def conversion_cache() -> ConversionCache:
+    global _cache
+    if _cache is None:
+        _cache = ConversionCache(cache_dir='data/cache',
+                                 max_bytes=int(os.environ.get('DRAWBOT_CACHE_MB', 512)) * 1024 * 1024)
+    return _cache
+
+
+def process_file(id, setup:BotSetup):
+    upload_dir = f"{UPLOAD_FOLDER}/{id}"
+    cache = conversion_cache()
+    cache_key = cache.key(f"{upload_dir}/input.svg", setup)
+    cache.clear_artifacts(upload_dir)
+    if cache.fetch(cache_key, upload_dir):
+        if not os.path.exists(f"{upload_dir}/{drawbot_thumbnails.THUMBNAIL_NAME}"):
+            # Cached before thumbnails were made
+            drawbot_thumbnails.write_thumbnail(upload_dir)
+        if not os.path.exists(f"{upload_dir}/{drawbot_thumbnails.CHECK_NAME}"):
+            drawbot_thumbnails.write_check(upload_dir, setup)
+        return
+    convert(upload_dir, setup)
+    cache.store(cache_key, upload_dir)
+
+
+def convert(upload_dir: str, setup:BotSetup) -> dict:
+    """Convert upload_dir/input.svg into drawing artifacts, bypassing the cache.
+
+    Returns the processing stats, including the seconds spent in each stage.
+    """
+    stage_times = {}
+    stage_start = time.perf_counter()
+
+    def stage_done(name):
+        nonlocal stage_start
+        now = time.perf_counter()
+        stage_times[name] = now - stage_start
+        stage_start = now
+
+    processor = TransformerSVGPathTools()
+    processor.pipeline(setup=setup,
+        input_svg=f"{upload_dir}/input.svg",
+        processed_svg=f"{upload_dir}/processed.svg",
+        output_gcode=f"{upload_dir}/converted.gcode",
+        check_gcode=f"{upload_dir}/gcode_check.svg",
+        annot_check_gcode=f"{upload_dir}/check.svg"
+        )
+    stage_done('pipeline')
+    # Simplify over-dense strokes and reorder them to cut down pen-up travel before drawing
+    stats = drawbot_paths.process_gcode_file(f"{upload_dir}/converted.gcode",
+                                             f"{upload_dir}/output.gcode",
+                                             simplify_tolerance=getattr(setup, 'simplify_tolerance', DEFAULT_SIMPLIFY_TOLERANCE))
+    stage_done('process')
+    # Index the command count now so drawing can start without a pre-scan
+    drawbot_gcode.write_index(f"{upload_dir}/output.gcode", stats['commands_after'])
+    # Parsed once for the time estimate and both previews
+    records = drawbot_gcode.parse_file(f"{upload_dir}/output.gcode")
+    stage_done('parse')
+    # Feature totals for the motion model, so the design page can estimate drawing time
+    stats['motion'] = drawbot_motion.file_features(f"{upload_dir}/output.gcode", setup, records)
+    stage_done('motion')
+    # Small raster for the upload lists, so browsers don't fetch and rasterize every full SVG
+    drawbot_thumbnails.write_thumbnail(upload_dir, records)
+    stage_done('thumbnail')
+    # The design page shows this rather than check.svg, which browsers are slow to draw for big files
+    drawbot_thumbnails.write_check(upload_dir, setup, records)
+    stage_done('check')
+    stats['stage_times'] = stage_times
+    with open(f"{upload_dir}/process_stats.json", 'w') as f:
+        json.dump(stats, f)
+    return stats
+
+
+def read_process_stats(id):
+    try:
+        with open(f"{UPLOAD_FOLDER}/{id}/process_stats.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
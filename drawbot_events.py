@@ -0,0 +1,174 @@
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import List
+
+from drawbot_control import StateListener, read_stroke_log
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+class _Subscriber:
+    """One browser connection, with a bounded queue of events waiting to be sent.
+
+    A connection following several bots subscribes to each of their listeners, and
+    waits on its own condition for any of them to publish.
+    """
+    def __init__(self, max_events: int):
+        self.max_events = max_events
+        self.events = deque()
+        self.resync = False
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def offer(self, event):
+        # Never block the publisher: a client that has fallen this far behind is sent a
+        # snapshot of the latest state instead of the backlog
+        with self.cond:
+            if len(self.events) >= self.max_events:
+                self.dropped += len(self.events)
+                self.events.clear()
+                self.resync = True
+            self.events.append(event)
+            self.cond.notify_all()
+
+
+class BrowserEventListener(StateListener):
+    """Fans drawbot state out to browsers as Server-Sent Events.
+
+    Listener callbacks only append to each subscriber's bounded queue, so a slow or
+    stalled client can never hold up DrawbotControl.send_block. Newly drawn
+    segments are read from the stroke log by each client's own stream, at that
+    client's pace. A named listener adds a bot field with its name to every event,
+    so one stream can carry a whole fleet.
+    """
+    def __init__(self, stroke_log_path: str = None, max_events=64, keepalive=15, max_points=5000, name: str = None):
+        self.stroke_log_path = stroke_log_path
+        self.max_events = max_events
+        self.keepalive = keepalive
+        self.max_points = max_points
+        self.name = name
+        self.latest = {}
+        self.subscribers = []
+        self._cond = threading.Condition()
+
+    def set_state(self,state:str):
+        self.publish('state', {'state': state})
+
+    def set_progress(self,progress:float,done:int,total:int):
+        self.publish('progress', {'progress': progress, 'done': done, 'total': total})
+
+    def set_estimated_time_left(self,time_left:float):
+        end_time = None
+        if time_left and time_left > 0:
+            end_time = (datetime.now() + timedelta(seconds=time_left)).strftime('%H:%M:%S')
+        self.publish('eta', {'seconds': time_left, 'end_time': end_time})
+
+    def set_target_image(self,image_path:str):
+        self.publish('target', {'image': image_path})
+
+    def publish(self, kind: str, data: dict):
+        with self._cond:
+            self.latest[kind] = data
+            for subscriber in self.subscribers:
+                subscriber.offer((self, kind, data))
+
+    def subscribe(self, subscriber: _Subscriber = None) -> _Subscriber:
+        subscriber = subscriber or _Subscriber(self.max_events)
+        with self._cond:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber):
+        with self._cond:
+            subscriber.closed = True
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def stream(self, offset=0, generation=None):
+        """Generator of SSE messages for one client of this bot alone"""
+        return stream([self], offsets={self: (offset, generation)}, max_events=self.max_events,
+                      keepalive=self.keepalive)
+
+    def _snapshot(self):
+        with self._cond:
+            latest = dict(self.latest)
+        for kind, data in latest.items():
+            yield self._format(kind, data)
+
+    def _format(self, kind: str, data: dict) -> str:
+        return _format(kind, dict(data, bot=self.name) if self.name is not None else data)
+
+    def _new_segments(self, offset, generation):
+        if not self.stroke_log_path:
+            return None
+        meta, start, points = read_stroke_log(self.stroke_log_path, offset, self.max_points)
+        if meta is None:
+            return None
+        reset = meta['generation'] != generation
+        if reset:
+            meta, start, points = read_stroke_log(self.stroke_log_path, 0, self.max_points)
+        if not reset and len(points) == 0:
+            return None
+        return {
+            'generation': meta['generation'],
+            'reset': reset,
+            'area': {k: meta[k] for k in ('x_margins', 'minimum_y_offset', 'width', 'height')},
+            'offset': start,
+            'next': start + len(points),
+            'points': points.round(2).tolist(),
+        }
+
+
+def stream(listeners: List[BrowserEventListener], offsets: dict = None, max_events=64, keepalive=15):
+    """Generator of SSE messages for one client following several bots over a single connection.
+
+    Starts with a snapshot of each bot's current state, then sends their events and
+    new segments as they come. offsets maps a listener to the (offset, generation)
+    of the stroke log the client already has.
+    """
+    subscriber = _Subscriber(max_events)
+    positions = {listener: (offsets or {}).get(listener, (0, None)) for listener in listeners}
+    for listener in listeners:
+        listener.subscribe(subscriber)
+    try:
+        for listener in listeners:
+            yield from listener._snapshot()
+        last_sent = time.time()
+        while True:
+            with subscriber.cond:
+                if not subscriber.events:
+                    subscriber.cond.wait(1.0)
+                events = list(subscriber.events)
+                subscriber.events.clear()
+                resync, subscriber.resync = subscriber.resync, False
+            if resync:
+                for listener in listeners:
+                    yield from listener._snapshot()
+            for listener, kind, data in events:
+                yield listener._format(kind, data)
+            sent = events or resync
+            for listener in listeners:
+                segments = listener._new_segments(*positions[listener])
+                if segments:
+                    positions[listener] = segments['next'], segments['generation']
+                    yield listener._format('segments', segments)
+                    sent = True
+            if sent:
+                last_sent = time.time()
+            elif time.time() - last_sent > keepalive:
+                last_sent = time.time()
+                yield ": keepalive\n\n"
+    finally:
+        for listener in listeners:
+            listener.unsubscribe(subscriber)
+        if subscriber.dropped:
+            print(f"Event subscriber dropped {subscriber.dropped} events while behind")
+
+
+def _format(kind: str, data: dict) -> str:
+    return f"event: {kind}\ndata: {json.dumps(data)}\n\n"
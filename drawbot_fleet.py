@@ -0,0 +1,208 @@
+# Several drawbots driven from one server process.
+#
+# The bots are listed in a JSON file, data/fleet.json or the path in DRAWBOT_FLEET:
+# [
+#  {"name": "left", "serialport": "/dev/ttyACM0"},
+#  {"name": "right", "serialport": "/dev/ttyACM1", "stream_window": 8, "buffer_bytes": 64,
+#   "setup": {"bot_width": 1000, "bot_height": 700}},
+#  {"name": "test", "fake": true}
+# ]
+# Without the file a single bot is configured from the environment, as before.
+#
+# Each bot has its own outputs, DrawbotControl, queue worker and files under
+# data/bots/<name>/. Drawings aren't assigned to a bot when they are queued:
+# every idle bot's worker claims the next job it is compatible with, so a job goes
+# to whichever compatible bot becomes free first, the least loaded one.
+
+import copy
+import json
+import os
+from typing import Dict, List
+
+from drawbot_converter.bot_setup import BotSetup
+
+from drawbot_control import DrawbotControl, FakeDrawbotOutput, SerialDrawbotOutput, PNGOutput, StrokeLogOutput
+from drawbot_conversion import DEFAULT_SIMPLIFY_TOLERANCE
+from drawbot_events import BrowserEventListener
+from drawbot_motion import MotionModel
+from drawbot_sim import SimulatedSerialPort
+from drawbot_tiles import StrokeTiles
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+FLEET_CONFIG_PATH = 'data/fleet.json'
+
+
+def bot_profile(setup) -> str:
+    """The geometry g-code is converted for; a drawing only fits bots with the same profile"""
+    return f"{int(setup.bot_width)}x{int(setup.bot_height)}"
+
+
+def default_setup() -> BotSetup:
+    setup = BotSetup().standard_magnets().a3_paper().rodalm_21_30()
+    setup.simplify_tolerance = DEFAULT_SIMPLIFY_TOLERANCE
+    return setup
+
+
+class Bot:
+    """One drawbot: its setup, outputs, controller and browser event stream.
+
+    The server adds the bot's HAConnection and JobWorker once it has made them.
+    """
+    def __init__(self, name: str, setup: BotSetup, outputs: list, data_dir: str, simulator=None):
+        """
+        Args:
+            name: Name used in job assignments, URLs and the HA device
+            setup: The bot's geometry, and the setup its drawings are converted with by default
+            outputs: The serial or fake output, without the preview outputs added here
+            data_dir: Where the bot's preview image, stroke log and motion model are kept
+            simulator: SimulatedSerialPort standing in for the bot, if any
+        """
+        self.name = name
+        self.setup = setup
+        self.data_dir = data_dir
+        self.simulator = simulator
+        os.makedirs(data_dir, exist_ok=True)
+        self.image_path = os.path.join(data_dir, 'png_output.png')
+        self.stroke_log_path = os.path.join(data_dir, 'strokes.bin')
+        self.motion_model_path = os.path.join(data_dir, 'motion_model.json')
+
+        # The live preview only needs to be viewable, cap its size so encoding stays cheap on the Pi
+        outputs.append(PNGOutput(output_path=self.image_path, max_size=2048))
+        # Clients poll /strokes with the last offset they saw instead of refetching the whole PNG
+        outputs.append(StrokeLogOutput(self.stroke_log_path, verbose=False))
+        self.outputs = outputs
+        self.controller = DrawbotControl(outputs=outputs, verbose=True,
+                                         motion_model=MotionModel.load(self.motion_model_path), name=name)
+        # Pushes state, progress, ETA and new segments to the web UI over Server-Sent Events
+        self.browser_events = BrowserEventListener(stroke_log_path=self.stroke_log_path, name=name)
+        self.controller.add_state_listener(self.browser_events)
+        # Zoomable preview rendered from the stroke log, a tile at a time
+        self.tiles = StrokeTiles(self.stroke_log_path)
+        self.ha = None
+        self.worker = None
+
+    @property
+    def profile(self) -> str:
+        return bot_profile(self.setup)
+
+    @property
+    def busy(self) -> bool:
+        return self.worker is not None and self.worker.current is not None
+
+    def apply_geometry(self, setup: BotSetup):
+        """Make a setup convert drawings for this bot"""
+        setup.bot_width = self.setup.bot_width
+        setup.bot_height = self.setup.bot_height
+
+    def metrics(self) -> dict:
+        metrics = {'listeners': self.controller.dispatch_metrics(), 'run': self.controller.run_metrics(),
+                   'outputs': self.controller.output_metrics(), 'profile': self.profile, 'busy': self.busy}
+        for output in self.outputs:
+            if isinstance(output, SerialDrawbotOutput):
+                metrics['serial'] = output.metrics()
+        if self.simulator is not None:
+            metrics['simulator'] = self.simulator.metrics()
+        return metrics
+
+
+def make_bot(config: dict, data_dir: str = None) -> Bot:
+    """Build a bot from its fleet.json entry
+
+    Args:
+        config: name, and optionally fake, simulate (speedup), sim_planner, serialport,
+            baud, stream_window, buffer_bytes, lock_path, idle_timeout and setup (BotSetup attributes)
+        data_dir: Defaults to data/bots/<name>
+    """
+    name = config['name']
+    setup = default_setup()
+    for key, value in config.get('setup', {}).items():
+        setattr(setup, key, value)
+    outputs = []
+    simulator = None
+    if config.get('fake'):
+        outputs.append(FakeDrawbotOutput(fake_delay=0.01, verbose=False))
+    else:
+        serial_factory = None
+        if config.get('simulate'):
+            # Load test the serial path against simulated firmware, `simulate` times faster than the bot
+            simulator = SimulatedSerialPort(planner_size=int(config.get('sim_planner', 1)),
+                                            bot_width=setup.bot_width, speedup=float(config['simulate']))
+            serial_factory = lambda: simulator
+        # A stream_window > 1 streams commands ahead of the firmware instead of waiting for each "ok",
+        # as many as fit its receive buffer unless buffer_bytes gives another size
+        outputs.append(SerialDrawbotOutput(serialport=config.get('serialport', '/dev/ttyACM0'),
+                                           baud=str(config.get('baud', '57600')),
+                                           verbose=False,
+                                           window=int(config.get('stream_window', 1)),
+                                           buffer_bytes=config.get('buffer_bytes'),
+                                           serial_factory=serial_factory,
+                                           lock_path=config.get('lock_path', f"/tmp/feed-{name}.lock"),
+                                           # Seconds the port and lock are kept between blocks, 0 to close after each
+                                           idle_timeout=config.get('idle_timeout', 120)))
+    return Bot(name, setup, outputs, data_dir or os.path.join('data', 'bots', name), simulator)
+
+
+def environment_config() -> dict:
+    """The single bot of a server without fleet.json, from the environment variables it has always used"""
+    buffer_bytes = os.environ.get('DRAWBOT_BUFFER_BYTES')
+    return {
+        'name': 'drawbot',
+        'fake': 'FAKE_DRAWBOT' in os.environ,
+        'simulate': (os.environ['DRAWBOT_SIMULATE'] or 1) if 'DRAWBOT_SIMULATE' in os.environ else None,
+        'sim_planner': os.environ.get('DRAWBOT_SIM_PLANNER', 1),
+        'stream_window': os.environ.get('DRAWBOT_STREAM_WINDOW', 1),
+        'buffer_bytes': int(buffer_bytes) if buffer_bytes else None,
+        'lock_path': '/tmp/feed.lock',
+        'idle_timeout': float(os.environ.get('DRAWBOT_IDLE_TIMEOUT', 120)),
+    }
+
+
+class Fleet:
+    """The bots one server drives, the first being the default"""
+    def __init__(self, bots: List[Bot]):
+        if not bots:
+            raise ValueError("A fleet needs at least one bot")
+        self.bots: Dict[str, Bot] = {}
+        for bot in bots:
+            if bot.name in self.bots:
+                raise ValueError(f"Two bots are called {bot.name}")
+            self.bots[bot.name] = bot
+
+    @classmethod
+    def load(cls, path: str = None) -> 'Fleet':
+        path = path or os.environ.get('DRAWBOT_FLEET', FLEET_CONFIG_PATH)
+        if not os.path.exists(path):
+            # The single bot keeps its files where they have always been
+            return cls([make_bot(environment_config(), data_dir='data')])
+        with open(path) as f:
+            configs = json.load(f)
+        print(f"Loading {len(configs)} bots from {path}")
+        return cls([make_bot(config) for config in configs])
+
+    def __iter__(self):
+        return iter(self.bots.values())
+
+    def __len__(self):
+        return len(self.bots)
+
+    @property
+    def default(self) -> Bot:
+        return next(iter(self.bots.values()))
+
+    def get(self, name: str = None) -> Bot:
+        """The named bot, or the default one if it isn't named or doesn't exist"""
+        return self.bots.get(name) or self.default
+
+    def compatible(self, setup) -> List[Bot]:
+        profile = bot_profile(setup)
+        return [bot for bot in self if bot.profile == profile]
+
+    def setup_for(self, name: str = None) -> BotSetup:
+        """A copy of a bot's setup for the upload form to edit"""
+        return copy.deepcopy(self.get(name).setup)
+
+    def metrics(self) -> dict:
+        return {bot.name: bot.metrics() for bot in self}
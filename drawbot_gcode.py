@@ -0,0 +1,104 @@
+import json
+import os
+from typing import Iterable, Iterator
+
+import numpy as np
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+def index_path(filepath: str) -> str:
+    """Path of the sidecar index stored next to a g-code file"""
+    return filepath + ".idx"
+
+
+def read_commands(filepath: str) -> Iterator[str]:
+    """Lazily yield the stripped, non-empty lines of a g-code file"""
+    with open(filepath) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def scan_commands(filepath: str) -> int:
+    """Count the non-empty lines of a g-code file without keeping them in memory"""
+    count = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            if not line.isspace():
+                count += 1
+    return count
+
+
+def write_index(filepath: str, count: int = None):
+    """Record the command count of a g-code file in its sidecar index"""
+    if count is None:
+        count = scan_commands(filepath)
+    stat = os.stat(filepath)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'count': count}
+    tmp_path = index_path(filepath) + ".tmp"
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path(filepath))
+    except OSError as e:
+        print(f"Could not write g-code index for {filepath}: {e}")
+    return index
+
+
+def read_index(filepath: str) -> dict:
+    """Return the sidecar index for a g-code file, or None if it is missing or stale"""
+    try:
+        with open(index_path(filepath)) as f:
+            index = json.load(f)
+        stat = os.stat(filepath)
+    except (OSError, ValueError):
+        return None
+    if index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime:
+        return None
+    return index
+
+
+def count_commands(filepath: str) -> int:
+    """Number of commands in a g-code file, from the sidecar index or a pre-scan"""
+    index = read_index(filepath)
+    if index is None:
+        index = write_index(filepath)
+    return index['count']
+
+
+# Parsed commands: one record per command, for the array operations of the renderers and the motion model
+OP_PEN = 0
+OP_MOVE = 1
+OP_RAW = 2
+COMMAND_DTYPE = np.dtype([('op', 'u1'), ('x', '<f4'), ('y', '<f4')])
+
+
+def parse_command(command: str):
+    """(op, x, y) of a command's text.
+
+    For OP_PEN x is 1 for pen down and 0 for pen up, for OP_MOVE x and y are the
+    target, and OP_RAW commands (calibration, comments) carry no coordinates.
+    """
+    if command == 'd1' or command == 'd0':
+        return OP_PEN, float(command == 'd1'), 0.0
+    if command.startswith('g'):
+        coords = command[1:].split(',')
+        if len(coords) == 2:
+            try:
+                return OP_MOVE, float(coords[0]), float(coords[1])
+            except ValueError:
+                pass
+    return OP_RAW, 0.0, 0.0
+
+
+def parse_commands(commands: Iterable[str]) -> np.ndarray:
+    """The records of a sequence of commands"""
+    return np.array([parse_command(command) for command in commands], dtype=COMMAND_DTYPE)
+
+
+def parse_file(filepath: str) -> np.ndarray:
+    """The records of a g-code file, one for each command read_commands yields"""
+    return parse_commands(read_commands(filepath))
@@ -10,7 +10,7 @@ from flask import url_for
 #logging.basicConfig(level=logging.DEBUG)
 
 class HAConnection:
-    def __init__(self,drawbot_control:DrawbotControl,config_url:str,mqtt_host="moominpappa.local",image_path:str=None,no_drawing_image_path:str='static/no_drawing.svg'):
+    def __init__(self,drawbot_control:DrawbotControl,config_url:str,mqtt_host="moominpappa.local",image_path:str=None,no_drawing_image_path:str='static/no_drawing.svg',name:str=None):
         self.image_path = image_path
         self.drawbot_control = drawbot_control
         drawbot_control.add_state_listener(self)
@@ -23,6 +23,10 @@ class HAConnection:
         drawbot_manufacturer="Dave" if self.fake else "Matt Venn"
         hostname=socket.gethostname()
         uid=f"{drawbot_type}_{hostname}".replace("\\s","_")
+        # One device per bot when the server drives several
+        if name:
+            uid=f"{uid}_{name}"
+            hostname=f"{hostname} {name}"
         self.image_url = f"{config_url}/{image_path}"
         self.no_drawing_image_url = f"{config_url}/{no_drawing_image_path}"
         self.uid = uid
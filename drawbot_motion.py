@@ -0,0 +1,181 @@
+# Kinematic time model for the polar drawbot.
+# The pen hangs from two strings wound on steppers at the top corners of the board,
+# so the time a move takes follows the change in string lengths, not the straight
+# line distance on the paper.
+
+import json
+import os
+
+import numpy as np
+
+import drawbot_gcode
+from drawbot_gcode import OP_PEN, OP_MOVE
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+# Where the bot starts and ends each drawing
+HOME = (380.0, 250.0)
+
+# Seconds per mm of string while drawing and while travelling, per pen lift or drop,
+# and per command. Rough figures for an uncalibrated bot, refined from recorded runs.
+FEATURES = ('draw', 'travel', 'pen', 'commands')
+DEFAULT_COEFFICIENTS = {'draw': 0.05, 'travel': 0.025, 'pen': 0.3, 'commands': 0.01}
+
+
+def string_lengths(x: np.ndarray, y: np.ndarray, bot_width: float):
+    """Lengths of the left and right strings with the pen at (x, y)"""
+    return np.hypot(x, y), np.hypot(bot_width - x, y)
+
+
+def command_features(op: np.ndarray, x: np.ndarray, y: np.ndarray, setup, start=HOME) -> np.ndarray:
+    """Per-command features as an (n, len(FEATURES)) array.
+
+    A move costs the larger of the two string length changes, as both motors turn
+    together; it counts as drawing if the last pen command before it was pen down.
+    The pen starts up at `start`.
+    """
+    n = len(op)
+    features = np.zeros((n, len(FEATURES)))
+    features[:, 3] = 1
+    if n == 0:
+        return features
+    is_pen = op == OP_PEN
+    is_move = op == OP_MOVE
+    features[:, 2] = is_pen
+
+    # Pen state in effect at each command, carried forward from the last pen command
+    last_pen = np.where(is_pen, np.arange(n), -1)
+    np.maximum.accumulate(last_pen, out=last_pen)
+    pen_down = np.where(last_pen >= 0, x[np.maximum(last_pen, 0)] == 1, False)
+
+    # Position before each move, carried forward from the previous move
+    move_index = np.flatnonzero(is_move)
+    mx = np.concatenate(([start[0]], x[move_index].astype(np.float64)))
+    my = np.concatenate(([start[1]], y[move_index].astype(np.float64)))
+    left, right = string_lengths(mx, my, setup.bot_width)
+    distance = np.maximum(np.abs(np.diff(left)), np.abs(np.diff(right)))
+    drawing = pen_down[move_index]
+    features[move_index, 0] = np.where(drawing, distance, 0)
+    features[move_index, 1] = np.where(drawing, 0, distance)
+    return features
+
+
+def file_features(filepath: str, setup, records: np.ndarray = None) -> dict:
+    """Feature totals for a g-code file, or None if there is none
+
+    Args:
+        records: The file's commands from drawbot_gcode.parse_file, if they are at hand
+    """
+    if records is None:
+        if not os.path.exists(filepath):
+            return None
+        records = drawbot_gcode.parse_file(filepath)
+    totals = command_features(records['op'], records['x'], records['y'], setup).sum(axis=0)
+    return dict(zip(FEATURES, totals.tolist()))
+
+
+class TimeEstimator:
+    """Time left in a block from per-command model costs.
+
+    The model's remaining time is scaled by how the run has paced against the model
+    so far, trusting the observed pace more as more of the drawing is done.
+    """
+    def __init__(self, costs: np.ndarray, trust_after=60.0):
+        self.done = np.concatenate(([0.0], np.cumsum(costs)))
+        self.total = float(self.done[-1])
+        self.trust_after = trust_after
+
+    def remaining(self, index: int, elapsed: float) -> float:
+        predicted_done = float(self.done[min(max(index, 0), len(self.done) - 1)])
+        remaining = self.total - predicted_done
+        if predicted_done > 0 and elapsed > 0:
+            weight = predicted_done / (predicted_done + self.trust_after)
+            remaining *= 1 + weight * (elapsed / predicted_done - 1)
+        return remaining
+
+
+class MotionModel:
+    """Linear time model over FEATURES, calibrated from completed runs.
+
+    Each completed drawing adds an observation of its feature totals and elapsed
+    time. The coefficients are fitted as multipliers of the defaults, regularised
+    towards a single common scale so that a handful of similar drawings can't
+    produce nonsense coefficients.
+    """
+    def __init__(self, path: str = None, coefficients: dict = None, observations: list = None,
+                 max_observations=50):
+        self.path = path
+        self.coefficients = dict(coefficients or DEFAULT_COEFFICIENTS)
+        self.observations = list(observations or [])
+        self.max_observations = max_observations
+
+    @classmethod
+    def load(cls, path: str) -> 'MotionModel':
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            return cls(path, data.get('coefficients'), data.get('observations'))
+        except FileNotFoundError:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            print(f"Could not read motion model {path}, using defaults: {e}")
+            return cls(path)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'coefficients': self.coefficients, 'observations': self.observations}, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Could not save motion model to {self.path}: {e}")
+
+    def _vector(self) -> np.ndarray:
+        return np.array([self.coefficients[name] for name in FEATURES])
+
+    def predict(self, features: dict) -> float:
+        """Predicted seconds for a drawing with the given feature totals"""
+        return float(sum(self.coefficients[name] * features.get(name, 0.0) for name in FEATURES))
+
+    def command_costs(self, features: np.ndarray) -> np.ndarray:
+        return features @ self._vector()
+
+    def observe(self, features: dict, elapsed: float):
+        """Record a completed run and refit the coefficients"""
+        if elapsed <= 0:
+            return
+        self.observations.append({'features': {name: features.get(name, 0.0) for name in FEATURES},
+                                  'elapsed': elapsed})
+        self.observations = self.observations[-self.max_observations:]
+        self.fit()
+
+    def fit(self, regularisation=0.1):
+        if not self.observations:
+            return
+        defaults = np.array([DEFAULT_COEFFICIENTS[name] for name in FEATURES])
+        # Each column is the time the default model predicts for that feature
+        a = np.array([[o['features'][name] for name in FEATURES] for o in self.observations]) * defaults
+        t = np.array([o['elapsed'] for o in self.observations])
+        predicted = a.sum(axis=1)
+        if predicted.sum() <= 0:
+            return
+        scale = t.sum() / predicted.sum()
+        # Ridge regression of the per-feature multipliers towards the common scale
+        lam = regularisation * max(np.trace(a.T @ a) / len(FEATURES), 1e-9)
+        multipliers = np.linalg.solve(a.T @ a + lam * np.eye(len(FEATURES)),
+                                      a.T @ t + lam * scale * np.ones(len(FEATURES)))
+        if not np.all(np.isfinite(multipliers)):
+            multipliers = np.full(len(FEATURES), scale)
+        multipliers = np.clip(multipliers, scale / 10, scale * 10)
+        self.coefficients = dict(zip(FEATURES, (defaults * multipliers).tolist()))
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return f"{max(minutes, 1)} min"
+    return f"{minutes // 60}h {minutes % 60:02d}m"
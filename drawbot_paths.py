@@ -0,0 +1,499 @@
+import math
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+import functools
+print = functools.partial(print, flush=True)
+
+# Bump when a change alters the g-code, the artifacts or the process stats produced from the
+# same input, so the conversion cache doesn't hand back entries made before it.
+# 2: compiled output.npy, motion features in the stats, thumbnail.png and check.png
+PROCESSING_VERSION = 2
+
+
+def parse_move(command: str) -> Optional[Tuple[float, float]]:
+    """Return the (x, y) of a "gx,y" move command, or None if it is not one"""
+    if not command.startswith('g'):
+        return None
+    coords = command[1:].split(',')
+    if len(coords) != 2:
+        return None
+    try:
+        return float(coords[0]), float(coords[1])
+    except ValueError:
+        return None
+
+
+class Stroke:
+    """A pen-down polyline, kept as the original move commands so output is byte-identical"""
+    __slots__ = ('moves', 'points')
+
+    def __init__(self, moves: List[str], points: List[Tuple[float, float]]):
+        # moves[0] is the pen-up travel to the start, the rest are drawn with the pen down
+        self.moves = moves
+        self.points = points
+
+    @property
+    def start(self):
+        return self.points[0]
+
+    @property
+    def end(self):
+        return self.points[-1]
+
+    def reversed(self) -> 'Stroke':
+        return Stroke(self.moves[::-1], self.points[::-1])
+
+    def simplified(self, tolerance: float) -> 'Stroke':
+        if len(self.points) <= 2:
+            return self
+        keep = simplify_polyline(np.array(self.points, dtype=float), tolerance).tolist()
+        if len(keep) == len(self.points):
+            return self
+        return Stroke([self.moves[k] for k in keep], [self.points[k] for k in keep])
+
+    def commands(self) -> Iterable[str]:
+        yield self.moves[0]
+        yield "d1"
+        yield from self.moves[1:]
+        yield "d0"
+
+
+class GcodeProgram:
+    """A g-code command stream split into runs of reorderable strokes and fixed commands.
+
+    Anything that is not a pen or move command (calibration, comments are dropped)
+    acts as a barrier: strokes are only reordered within the run between barriers.
+    """
+    def __init__(self):
+        # Each section is either a list of Strokes or a single raw command
+        self.sections = []
+        self.origins = []
+        self.optimizable = True
+
+    @classmethod
+    def parse(cls, commands: Iterable[str]) -> 'GcodeProgram':
+        program = cls()
+        strokes = []
+        stroke = None
+        pos_cmd = None
+        pos = None
+        emitted_pos = None
+        travel_pending = False
+        origin = None
+
+        def flush():
+            nonlocal strokes
+            if strokes:
+                program.sections.append(strokes)
+                program.origins.append(origin)
+                strokes = []
+
+        for command in commands:
+            if command.startswith('#'):
+                continue
+            if command == 'd1':
+                if stroke is not None:
+                    continue
+                if pos_cmd is None:
+                    program.optimizable = False
+                    break
+                if not strokes:
+                    origin = emitted_pos
+                stroke = Stroke([pos_cmd], [pos])
+                travel_pending = False
+            elif command == 'd0':
+                if stroke is not None:
+                    strokes.append(stroke)
+                    stroke = None
+            else:
+                move = parse_move(command)
+                if move is not None:
+                    pos_cmd, pos = command, move
+                    if stroke is not None:
+                        stroke.moves.append(command)
+                        stroke.points.append(move)
+                    else:
+                        travel_pending = True
+                    continue
+                if stroke is not None:
+                    # A barrier with the pen down cannot be reordered around safely
+                    program.optimizable = False
+                    break
+                flush()
+                if pos_cmd is not None:
+                    # Put the pen back where the original program had it
+                    program.sections.append(pos_cmd)
+                    emitted_pos = pos
+                travel_pending = False
+                program.sections.append(command)
+        if stroke is not None:
+            strokes.append(stroke)
+        flush()
+        if travel_pending:
+            program.sections.append(pos_cmd)
+        return program
+
+    @property
+    def stroke_count(self) -> int:
+        return sum(len(s) for s in self.sections if isinstance(s, list))
+
+    def commands(self) -> Iterable[str]:
+        for section in self.sections:
+            if isinstance(section, list):
+                for stroke in section:
+                    yield from stroke.commands()
+            else:
+                yield section
+
+    def travel(self) -> float:
+        """Total pen-up travel distance between strokes, in bot units (mm)"""
+        total = 0.0
+        for section, origin in zip(self.stroke_sections(), self.origins):
+            starts, ends = endpoint_arrays(section)
+            total += travel_distance(starts, ends, origin)
+        return total
+
+    def stroke_sections(self) -> List[List[Stroke]]:
+        return [s for s in self.sections if isinstance(s, list)]
+
+    def simplify(self, tolerance: float):
+        """Drop stroke points that deviate from the simplified line by at most tolerance (mm)"""
+        strokes = [stroke for section in self.stroke_sections() for stroke in section]
+        if not strokes:
+            return
+        # Every stroke is simplified in one go, per-stroke NumPy calls would dominate
+        lengths = np.array([len(stroke.points) for stroke in strokes])
+        bounds = np.concatenate([[0], np.cumsum(lengths)])
+        points = np.array([point for stroke in strokes for point in stroke.points], dtype=float)
+        keep = simplify_polylines(points, bounds, tolerance)
+        kept_bounds = np.searchsorted(keep, bounds).tolist()
+        keep = keep.tolist()
+        simplified = []
+        for stroke, first, start, end in zip(strokes, bounds.tolist(), kept_bounds, kept_bounds[1:]):
+            # As Stroke.simplified, a stroke of two points is left alone even if they coincide
+            if len(stroke.points) > 2 and end - start < len(stroke.points):
+                indices = [k - first for k in keep[start:end]]
+                stroke = Stroke([stroke.moves[k] for k in indices], [stroke.points[k] for k in indices])
+            simplified.append(stroke)
+        simplified = iter(simplified)
+        for i, section in enumerate(self.sections):
+            if isinstance(section, list):
+                self.sections[i] = [next(simplified) for _ in section]
+
+    def optimize(self, window=30, max_passes=3):
+        """Reorder and reverse strokes in every section to reduce pen-up travel"""
+        index = 0
+        for i, section in enumerate(self.sections):
+            if not isinstance(section, list):
+                continue
+            origin = self.origins[index]
+            index += 1
+            if len(section) < 2:
+                continue
+            starts, ends = endpoint_arrays(section)
+            order, flipped = order_strokes(starts, ends, origin, window=window, max_passes=max_passes)
+            self.sections[i] = [section[k].reversed() if f else section[k]
+                                for k, f in zip(order.tolist(), flipped.tolist())]
+
+
+def merge_collinear(points: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    """Mask of the points left after dropping repeats and points on a straight run.
+
+    points holds polylines one after another, polyline i being points[bounds[i]:bounds[i + 1]];
+    the first point of each is always kept.
+    """
+    first = np.zeros(len(points), dtype=bool)
+    first[bounds[:-1]] = True
+    keep = first.copy()
+    keep[1:] |= np.hypot(*np.diff(points, axis=0).T) > 1e-9
+    idx = np.flatnonzero(keep)
+    line = np.cumsum(first)[idx]
+    # Points with a neighbour on the same polyline either side, the only ones that can be dropped
+    inner = np.flatnonzero(line[1:-1] == line[:-2]) if len(idx) > 2 else np.zeros(0, dtype=int)
+    inner = inner[line[inner + 2] == line[inner + 1]] + 1
+    pts = points[idx]
+    v1 = pts[inner] - pts[inner - 1]
+    v2 = pts[inner + 1] - pts[inner]
+    cross = v1[:, 0] * v2[:, 1] - v1[:, 1] * v2[:, 0]
+    dot = (v1 * v2).sum(axis=1)
+    # Only merge when the line carries straight on; a point where the pen turns back is kept
+    straight = (np.abs(cross) <= 1e-9 * np.hypot(*v1.T) * np.hypot(*v2.T)) & (dot > 0)
+    keep[idx[inner[straight]]] = False
+    return keep
+
+
+def ramer_douglas_peucker(points: np.ndarray, first: np.ndarray, last: np.ndarray, tolerance: float) -> np.ndarray:
+    """Mask of the points kept by Ramer-Douglas-Peucker using distance to the chord segment.
+
+    Simplifies every polyline points[first[i]:last[i] + 1] at once: each pass splits all
+    the spans still too far from their chord, so the NumPy calls scale with the depth of
+    the recursion rather than the number of polylines.
+    """
+    keep = np.zeros(len(points), dtype=bool)
+    keep[first] = keep[last] = True
+    while len(first):
+        inner = last - first - 1
+        spans = inner > 0
+        first, last, inner = first[spans], last[spans], inner[spans]
+        if not len(first):
+            break
+        offsets = np.cumsum(inner) - inner
+        span = np.repeat(np.arange(len(first)), inner)
+        idx = first[span] + 1 + np.arange(len(span)) - offsets[span]
+        a = points[first][span]
+        chord = (points[last] - points[first])[span]
+        length2 = (chord * chord).sum(axis=1)
+        t = np.divide(((points[idx] - a) * chord).sum(axis=1), length2, out=np.zeros(len(idx)), where=length2 > 0)
+        nearest = a + np.clip(t, 0.0, 1.0)[:, None] * chord
+        dist = np.hypot(*(points[idx] - nearest).T)
+        peak = np.maximum.reduceat(dist, offsets)
+        # The first point at each span's peak, as argmax would choose
+        at_peak = np.flatnonzero(dist == peak[span])
+        split = idx[at_peak[np.unique(span[at_peak], return_index=True)[1]]]
+        far = peak > tolerance
+        split = split[far]
+        keep[split] = True
+        first, last = np.concatenate([first[far], split]), np.concatenate([split, last[far]])
+    return keep
+
+
+def simplify_polylines(points: np.ndarray, bounds: np.ndarray, tolerance: float) -> np.ndarray:
+    """Indices of the points of many polylines to keep, always including the ends of each.
+
+    points holds the polylines one after another, polyline i being points[bounds[i]:bounds[i + 1]].
+    """
+    keep = np.flatnonzero(merge_collinear(points, bounds))
+    if tolerance > 0 and len(keep) > 2:
+        line = np.searchsorted(bounds, keep, side='right') - 1
+        kept_bounds = np.searchsorted(line, np.arange(len(bounds)))
+        keep = keep[ramer_douglas_peucker(points[keep], kept_bounds[:-1], kept_bounds[1:] - 1, tolerance)]
+    return keep
+
+
+def simplify_polyline(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """Indices of the points of a polyline to keep, always including both ends"""
+    return simplify_polylines(points, np.array([0, len(points)]), tolerance)
+
+
+def endpoint_arrays(strokes: List[Stroke]) -> Tuple[np.ndarray, np.ndarray]:
+    starts = np.array([s.start for s in strokes], dtype=float).reshape(-1, 2)
+    ends = np.array([s.end for s in strokes], dtype=float).reshape(-1, 2)
+    return starts, ends
+
+
+def travel_distance(starts: np.ndarray, ends: np.ndarray, origin=None) -> float:
+    """Pen-up distance to draw strokes in the given order, starting from origin"""
+    if len(starts) == 0:
+        return 0.0
+    total = float(np.hypot(*(starts[1:] - ends[:-1]).T).sum())
+    if origin is not None:
+        total += math.hypot(starts[0][0] - origin[0], starts[0][1] - origin[1])
+    return total
+
+
+class _EndpointGrid:
+    """Uniform grid over stroke endpoints for nearest-unvisited queries.
+
+    Built vectorised with NumPy into a CSR layout; queries walk rings of cells
+    outwards from the query point. The grid is rebuilt over the surviving points
+    once most have been removed, so late queries don't scan empty cells.
+    """
+    def __init__(self, points: np.ndarray):
+        self.points = points
+        self.xs = points[:, 0].tolist()
+        self.ys = points[:, 1].tolist()
+        self.alive = [True] * len(points)
+        self.alive_count = len(points)
+        self._build(np.arange(len(points)))
+
+    def _build(self, idx: np.ndarray):
+        pts = self.points[idx]
+        self.lo = pts.min(axis=0)
+        extent = pts.max(axis=0) - self.lo
+        area = max(float(extent[0]) * float(extent[1]), float(extent.max()) ** 2 / len(idx), 1e-12)
+        # Aim for about two endpoints per cell
+        self.cell = math.sqrt(2 * area / len(idx)) or 1.0
+        self.nx = int(extent[0] / self.cell) + 1
+        self.ny = int(extent[1] / self.cell) + 1
+        cx = np.minimum(((pts[:, 0] - self.lo[0]) / self.cell).astype(np.int64), self.nx - 1)
+        cy = np.minimum(((pts[:, 1] - self.lo[1]) / self.cell).astype(np.int64), self.ny - 1)
+        cid = cy * self.nx + cx
+        order = np.argsort(cid, kind='stable')
+        self.cell_points = idx[order].tolist()
+        self.cell_start = np.searchsorted(cid[order], np.arange(self.nx * self.ny + 1)).tolist()
+        self.cell_alive = np.bincount(cid, minlength=self.nx * self.ny).tolist()
+        self.point_cell = {}
+        for p, c in zip(idx.tolist(), cid.tolist()):
+            self.point_cell[p] = c
+        self.built_count = len(idx)
+
+    def remove(self, p: int):
+        if self.alive[p]:
+            self.alive[p] = False
+            self.alive_count -= 1
+            self.cell_alive[self.point_cell[p]] -= 1
+
+    def nearest(self, x: float, y: float) -> int:
+        if self.alive_count < self.built_count // 4 and self.alive_count > 64:
+            self._build(np.flatnonzero(np.array(self.alive)))
+        cell = self.cell
+        cx = min(max(int((x - self.lo[0]) / cell), 0), self.nx - 1)
+        cy = min(max(int((y - self.lo[1]) / cell), 0), self.ny - 1)
+        max_ring = max(cx, self.nx - 1 - cx, cy, self.ny - 1 - cy)
+        best, best_d = -1, math.inf
+        xs, ys, alive = self.xs, self.ys, self.alive
+        starts, points, cell_alive = self.cell_start, self.cell_points, self.cell_alive
+        for r in range(max_ring + 1):
+            for gx, gy in self._ring(cx, cy, r):
+                c = gy * self.nx + gx
+                if not cell_alive[c]:
+                    continue
+                for k in range(starts[c], starts[c + 1]):
+                    p = points[k]
+                    if alive[p]:
+                        d = (xs[p] - x) ** 2 + (ys[p] - y) ** 2
+                        if d < best_d:
+                            best, best_d = p, d
+            # Anything in a further ring is at least r cells away
+            if best >= 0 and best_d <= (r * cell) ** 2:
+                break
+        return best
+
+    def _ring(self, cx: int, cy: int, r: int):
+        if r == 0:
+            yield cx, cy
+            return
+        nx, ny = self.nx, self.ny
+        x0, x1 = max(cx - r, 0), min(cx + r, nx - 1)
+        for gy in (cy - r, cy + r):
+            if 0 <= gy < ny:
+                for gx in range(x0, x1 + 1):
+                    yield gx, gy
+        y0, y1 = max(cy - r + 1, 0), min(cy + r - 1, ny - 1)
+        for gx in (cx - r, cx + r):
+            if 0 <= gx < nx:
+                for gy in range(y0, y1 + 1):
+                    yield gx, gy
+
+
+def greedy_order(starts: np.ndarray, ends: np.ndarray, origin=None) -> Tuple[np.ndarray, np.ndarray]:
+    """Nearest-neighbour tour: repeatedly draw the stroke with the closest free endpoint"""
+    n = len(starts)
+    grid = _EndpointGrid(np.concatenate([starts, ends]))
+    order = np.empty(n, dtype=np.int64)
+    flipped = np.empty(n, dtype=bool)
+    x, y = origin if origin is not None else starts[0]
+    for step in range(n):
+        p = grid.nearest(x, y)
+        stroke, flip = p % n, p >= n
+        order[step] = stroke
+        flipped[step] = flip
+        grid.remove(stroke)
+        grid.remove(stroke + n)
+        # A reversed stroke finishes at its start point
+        end = stroke if flip else stroke + n
+        x, y = grid.xs[end], grid.ys[end]
+    return order, flipped
+
+
+def two_opt(starts: np.ndarray, ends: np.ndarray, order: np.ndarray, flipped: np.ndarray,
+            origin=None, window=30, max_passes=3, min_improvement=0.002) -> Tuple[np.ndarray, np.ndarray]:
+    """Windowed 2-opt over an open stroke tour.
+
+    Reversing the block of strokes i+1..j (and flipping each of them) only changes
+    the two travel moves at the block's edges, so the gain of every block of length
+    w can be computed at once with NumPy. Non-overlapping improving blocks are
+    applied together, and passes repeat until one improves the travel by less than
+    min_improvement (as a fraction).
+    """
+    n = len(order)
+    order = order.copy()
+    flipped = flipped.copy()
+    if origin is None:
+        origin = ends[order[0]] if flipped[0] else starts[order[0]]
+    origin = np.asarray(origin, dtype=float).reshape(1, 2)
+    for _ in range(max_passes):
+        pass_gain = 0.0
+        for w in range(1, min(window, n) + 1):
+            # Placed endpoints, with the fixed origin as node 0 and no node after the last
+            s, e = _placed(starts, ends, order, flipped)
+            s = np.concatenate([origin, s])
+            e = np.concatenate([origin, e])
+            m = n + 1
+            i = np.arange(0, m - w)
+            j = i + w
+            a, b, c = e[i], s[i + 1], e[j]
+            has_d = j + 1 < m
+            d = s[np.minimum(j + 1, m - 1)]
+            gain = np.hypot(*(a - b).T) - np.hypot(*(a - c).T)
+            gain += np.where(has_d, np.hypot(*(c - d).T) - np.hypot(*(b - d).T), 0.0)
+            candidates = np.flatnonzero(gain > 1e-9)
+            last_end = -1
+            for k in candidates.tolist():
+                if k < last_end:
+                    continue
+                pass_gain += gain[k]
+                # Tour node t is order[t - 1]
+                lo, hi = k, k + w
+                order[lo:hi] = order[lo:hi][::-1]
+                flipped[lo:hi] = ~flipped[lo:hi][::-1]
+                last_end = k + w + 1
+        if pass_gain <= min_improvement * travel_distance(*_placed(starts, ends, order, flipped), origin[0]):
+            break
+    return order, flipped
+
+
+def _placed(starts: np.ndarray, ends: np.ndarray, order: np.ndarray, flipped: np.ndarray):
+    """Start and end points of strokes in drawing order, accounting for reversal"""
+    placed_starts = np.where(flipped[:, None], ends[order], starts[order])
+    placed_ends = np.where(flipped[:, None], starts[order], ends[order])
+    return placed_starts, placed_ends
+
+
+def order_strokes(starts: np.ndarray, ends: np.ndarray, origin=None, window=30, max_passes=3):
+    """Choose a drawing order and direction for each stroke to minimise pen-up travel"""
+    order, flipped = greedy_order(starts, ends, origin)
+    return two_opt(starts, ends, order, flipped, origin, window=window, max_passes=max_passes)
+
+
+def process_gcode_file(input_path: str, output_path: str, simplify_tolerance: float = 0.0) -> dict:
+    """Simplify and reorder the strokes of a g-code file and write the result.
+
+    Returns statistics on the command count and pen-up travel before and after.
+    """
+    start_time = time.time()
+    with open(input_path) as f:
+        commands = [line.strip() for line in f if line.strip()]
+    program = GcodeProgram.parse(commands)
+    stats = {
+        'commands_before': len(commands),
+        'strokes': program.stroke_count if program.optimizable else 0,
+        'simplify_tolerance': simplify_tolerance,
+        'travel_before': 0.0,
+        'travel_after': 0.0,
+    }
+    if program.optimizable:
+        program.simplify(simplify_tolerance)
+        stats['travel_before'] = program.travel()
+        program.optimize()
+        stats['travel_after'] = program.travel()
+        commands = list(program.commands())
+    else:
+        print(f"Not simplifying or reordering {input_path}: pen is down across a non-move command")
+    stats['commands_after'] = len(commands)
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        for command in commands:
+            f.write(command)
+            f.write("\n")
+    os.replace(tmp_path, output_path)
+    stats['process_time'] = time.time() - start_time
+    print(f"Commands {stats['commands_before']} -> {stats['commands_after']}, "
+          f"pen-up travel {stats['travel_before']:.0f} -> {stats['travel_after']:.0f} "
+          f"over {stats['strokes']} strokes in {stats['process_time']:.2f}s")
+    return stats
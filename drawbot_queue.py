@@ -0,0 +1,368 @@
+# Durable job queue for the drawbot, kept in a local SQLite database so queued
+# drawings survive a server restart.
+
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+from drawbot_converter.bot_setup import BotSetup
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    args TEXT NOT NULL,
+    setup BLOB,
+    priority INTEGER NOT NULL DEFAULT 0,
+    position REAL NOT NULL,
+    state TEXT NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    bot TEXT,
+    profile TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, position);
+CREATE TABLE IF NOT EXISTS job_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    time REAL NOT NULL,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS job_history_job ON job_history (job_id);
+"""
+# Columns added since the first schema, added to older databases when they are opened
+MIGRATIONS = {
+    'bot': "ALTER TABLE jobs ADD COLUMN bot TEXT",
+    'profile': "ALTER TABLE jobs ADD COLUMN profile TEXT",
+}
+
+
+class JobQueue:
+    """Jobs waiting for the drawbot or the converter, highest priority first.
+
+    Within a priority jobs run in order of their position, which starts as the
+    submission order and is changed by move(). Every state change is also appended
+    to job_history. The BotSetup a job should run with is stored alongside it as
+    JSON of its attributes, which survives changes to the BotSetup class; setups
+    pickled by older versions are converted when the database is opened. A job
+    whose setup can't be read is failed when claimed instead of run.
+
+    With several drawbots a job can name the bot it must run on, or only the bot
+    geometry (profile) it needs, in which case whichever compatible bot is free
+    first claims it.
+    """
+    def __init__(self, db_path='data/jobs.db'):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            columns = {row['name'] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    db.execute(statement)
+            self._migrate_pickled_setups(db)
+
+    @contextmanager
+    def _connect(self):
+        """A connection that commits on success and is always closed"""
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _migrate_pickled_setups(self, db):
+        """Rewrite setups pickled by older versions as JSON, failing queued jobs whose setup won't load"""
+        rows = db.execute("SELECT id, state, setup FROM jobs WHERE typeof(setup) = 'blob'").fetchall()
+        if not rows:
+            return
+        import pickle
+        for row in rows:
+            try:
+                setup = encode_setup(pickle.loads(row['setup']))
+            except Exception as e:
+                setup = None
+                if row['state'] == QUEUED:
+                    error = f"Unreadable setup: {e}"
+                    db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                               (FAILED, time.time(), error, row['id']))
+                    self._record(db, row['id'], FAILED, error)
+            db.execute("UPDATE jobs SET setup = ? WHERE id = ?", (setup, row['id']))
+        print(f"Converted {len(rows)} pickled job setups to JSON")
+
+    def _record(self, db, job_id: int, state: str, detail: str = None):
+        db.execute("INSERT INTO job_history (job_id, state, time, detail) VALUES (?, ?, ?, ?)",
+                   (job_id, state, time.time(), detail))
+
+    def submit(self, kind: str, args: dict, setup=None, priority=0, bot: str = None, profile: str = None) -> int:
+        """Add a job to the end of its priority and return its id
+
+        Args:
+            bot: Only this bot may run the job
+            profile: Only bots with this profile may run the job
+        """
+        now = time.time()
+        with self._cond:
+            with self._connect() as db:
+                cursor = db.execute(
+                    "INSERT INTO jobs (kind, args, setup, priority, position, state, created, bot, profile) "
+                    "VALUES (?, ?, ?, ?, (SELECT COALESCE(MAX(position), 0) + 1 FROM jobs), ?, ?, ?, ?)",
+                    (kind, json.dumps(args), encode_setup(setup),
+                     priority, QUEUED, now, bot, profile))
+                job_id = cursor.lastrowid
+                self._record(db, job_id, QUEUED)
+            self._cond.notify_all()
+        return job_id
+
+    def claim(self, kinds=None, timeout: float = None, bot: str = None, profile: str = None) -> Optional[dict]:
+        """Mark the next queued job of one of kinds as running and return it.
+
+        Waits up to timeout seconds for a job to be submitted, returns None if none was.
+        If bot is given only jobs for that bot or for any bot are claimed, and the job
+        is assigned to it; if profile is given, only jobs needing no or that profile.
+        """
+        deadline = time.time() + timeout if timeout else None
+        with self._cond:
+            while True:
+                with self._connect() as db:
+                    query = "SELECT * FROM jobs WHERE state = ?"
+                    params = [QUEUED]
+                    if kinds:
+                        query += f" AND kind IN ({','.join('?' * len(kinds))})"
+                        params += list(kinds)
+                    if bot is not None:
+                        query += " AND (bot IS NULL OR bot = ?)"
+                        params.append(bot)
+                    if profile is not None:
+                        query += " AND (profile IS NULL OR profile = ?)"
+                        params.append(profile)
+                    row = db.execute(query + " ORDER BY priority DESC, position LIMIT 1", params).fetchone()
+                    if row is not None:
+                        now = time.time()
+                        assigned = row['bot'] or bot
+                        db.execute("UPDATE jobs SET state = ?, started = ?, bot = ? WHERE id = ?",
+                                   (RUNNING, now, assigned, row['id']))
+                        self._record(db, row['id'], RUNNING, f"on {assigned}" if assigned else None)
+                        job = _job(row)
+                        if 'setup_error' in job:
+                            print(f"Failing job {row['id']}: {job['setup_error']}")
+                            db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                                       (FAILED, now, job['setup_error'], row['id']))
+                            self._record(db, row['id'], FAILED, job['setup_error'])
+                            continue
+                        job.update(state=RUNNING, started=now, bot=assigned)
+                        return job
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def finish(self, job_id: int, state: str, error: str = None):
+        with self._cond:
+            with self._connect() as db:
+                db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                           (state, time.time(), error, job_id))
+                self._record(db, job_id, state, error)
+            self._cond.notify_all()
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a job that hasn't started; returns False if it isn't waiting"""
+        with self._cond:
+            with self._connect() as db:
+                cursor = db.execute("UPDATE jobs SET state = ?, finished = ? WHERE id = ? AND state = ?",
+                                    (CANCELLED, time.time(), job_id, QUEUED))
+                if cursor.rowcount:
+                    self._record(db, job_id, CANCELLED)
+                return bool(cursor.rowcount)
+
+    def move(self, job_id: int, direction: int) -> bool:
+        """Swap a queued job with its neighbour: direction -1 runs it sooner, +1 later"""
+        with self._cond:
+            with self._connect() as db:
+                rows = db.execute("SELECT id, priority, position FROM jobs WHERE state = ? "
+                                  "ORDER BY priority DESC, position", (QUEUED,)).fetchall()
+                ids = [row['id'] for row in rows]
+                if job_id not in ids:
+                    return False
+                index = ids.index(job_id)
+                other = index + direction
+                if not 0 <= other < len(rows):
+                    return False
+                a, b = rows[index], rows[other]
+                # Taking the neighbour's priority as well lets a job move past a priority boundary
+                db.execute("UPDATE jobs SET priority = ?, position = ? WHERE id = ?", (b['priority'], b['position'], a['id']))
+                db.execute("UPDATE jobs SET priority = ?, position = ? WHERE id = ?", (a['priority'], a['position'], b['id']))
+                self._record(db, job_id, QUEUED, "moved up" if direction < 0 else "moved down")
+                return True
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def jobs(self, states=ACTIVE_STATES, kinds=None, limit=50, bot: str = None) -> List[dict]:
+        """Jobs in the given states, in the order they will run (or most recent first once finished)"""
+        query = f"SELECT * FROM jobs WHERE state IN ({','.join('?' * len(states))})"
+        params = list(states)
+        if kinds:
+            query += f" AND kind IN ({','.join('?' * len(kinds))})"
+            params += list(kinds)
+        if bot is not None:
+            query += " AND bot = ?"
+            params.append(bot)
+        order = "state = 'running' DESC, priority DESC, position" if set(states) <= set(ACTIVE_STATES) else "created DESC"
+        with self._connect() as db:
+            rows = db.execute(f"{query} ORDER BY {order} LIMIT ?", params + [limit]).fetchall()
+        return [_job(row) for row in rows]
+
+    def latest(self, kind: str, design_id: str) -> Optional[dict]:
+        """Most recently submitted job of kind for a design"""
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE kind = ? AND json_extract(args, '$.id') = ? "
+                             "ORDER BY id DESC LIMIT 1", (kind, design_id)).fetchone()
+        return _job(row) if row else None
+
+    def history(self, job_id: int) -> List[dict]:
+        with self._connect() as db:
+            rows = db.execute("SELECT state, time, detail FROM job_history WHERE job_id = ? ORDER BY id",
+                              (job_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def recover(self, requeue_kinds=()):
+        """Deal with jobs left running by a previous server process.
+
+        Jobs of requeue_kinds are safe to run again from the start and are queued
+        again; anything else (a half drawn drawing) is marked failed.
+        """
+        with self._cond:
+            with self._connect() as db:
+                for row in db.execute("SELECT id, kind FROM jobs WHERE state = ?", (RUNNING,)).fetchall():
+                    if row['kind'] in requeue_kinds:
+                        db.execute("UPDATE jobs SET state = ?, started = NULL WHERE id = ?", (QUEUED, row['id']))
+                        self._record(db, row['id'], QUEUED, "requeued after restart")
+                    else:
+                        db.execute("UPDATE jobs SET state = ?, finished = ?, error = ? WHERE id = ?",
+                                   (FAILED, time.time(), "Interrupted by server restart", row['id']))
+                        self._record(db, row['id'], FAILED, "Interrupted by server restart")
+            self._cond.notify_all()
+
+
+def encode_setup(setup) -> Optional[str]:
+    """A BotSetup as JSON of its attributes, as the conversion cache keys on them"""
+    return json.dumps(vars(setup), sort_keys=True, default=str) if setup is not None else None
+
+
+def decode_setup(value) -> Optional[BotSetup]:
+    if value is None:
+        return None
+    setup = BotSetup()
+    for key, attribute in json.loads(value).items():
+        setattr(setup, key, attribute)
+    return setup
+
+
+def _job(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    job['args'] = json.loads(job['args'])
+    try:
+        job['setup'] = decode_setup(job['setup'])
+    except Exception as e:
+        # Listings still show the job, and claim() fails it rather than running it
+        job['setup'] = None
+        job['setup_error'] = f"Unreadable setup: {e}"
+    return job
+
+
+class JobWorker:
+    """Thread that runs jobs of some kinds from a JobQueue, one at a time.
+
+    Handlers are called as handler(job, cancel_event). A handler may return a
+    concurrent.futures.Future, in which case the job finishes when the future does
+    and the worker moves straight on to the next job.
+
+    A worker for one of several bots passes its bot name and profile, and only
+    claims jobs that bot can run.
+    """
+    def __init__(self, queue: JobQueue, handlers: Dict[str, Callable], name="drawbot-jobs", poll_interval=5.0,
+                 bot: str = None, profile: str = None):
+        self.queue = queue
+        self.handlers = handlers
+        self.name = name
+        self.poll_interval = poll_interval
+        self.bot = bot
+        self.profile = profile
+        self.current = None
+        self.cancel_event = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a queued job, or stop the running one"""
+        if self.queue.cancel(job_id):
+            return True
+        current, cancel_event = self.current, self.cancel_event
+        if current is not None and current['id'] == job_id:
+            cancel_event.set()
+            return True
+        return False
+
+    def _run(self):
+        while True:
+            try:
+                job = self.queue.claim(kinds=list(self.handlers), timeout=self.poll_interval,
+                                       bot=self.bot, profile=self.profile)
+            except Exception as e:
+                # The worker must outlive a bad row or a locked database, or the bot stops taking jobs
+                print(f"Error claiming a job: {e}")
+                time.sleep(self.poll_interval)
+                continue
+            if job is None:
+                continue
+            self.cancel_event = threading.Event()
+            self.current = job
+            try:
+                result = self.handlers[job['kind']](job, self.cancel_event)
+            except Exception as e:
+                import traceback
+                print(f"Error running job {job['id']} ({job['kind']} {job['args']}): {e}")
+                traceback.print_exc()
+                self.queue.finish(job['id'], FAILED, str(e))
+            else:
+                if hasattr(result, 'add_done_callback'):
+                    result.add_done_callback(functools.partial(self._future_done, job['id']))
+                else:
+                    self.queue.finish(job['id'], CANCELLED if self.cancel_event.is_set() else DONE)
+            finally:
+                self.current = None
+
+    def _future_done(self, job_id: int, future):
+        error = future.exception()
+        if error is not None:
+            print(f"Error running job {job_id}: {error}")
+            self.queue.finish(job_id, FAILED, str(error))
+        else:
+            self.queue.finish(job_id, DONE)
@@ -4,59 +4,114 @@
 # flask run
 
 
-from flask import Flask, render_template, send_from_directory, flash, request, redirect, url_for, current_app
+from flask import Flask, render_template, send_from_directory, flash, request, redirect, current_app, jsonify, send_file, Response, stream_with_context, abort
 from flask.signals import appcontext_pushed
 
 import os
 import random
 import string
-from drawbot_converter.transformer_svgpathtools import TransformerSVGPathTools
 
 from drawbot_converter.bot_setup import BotSetup
 import drawbot_converter.process as pr
 
-from flask_executor import Executor
 from datetime import datetime
 
-from drawbot_control import DrawbotControl, FakeDrawbotOutput, SerialDrawbotOutput, PNGOutput
+from drawbot_control import read_stroke_log, render_stroke_log
 from drawbot_ha import HAConnection
-import uuid  # Add this import at the top
-import threading
+import drawbot_conversion
+from drawbot_conversion import read_process_stats
+from drawbot_stats import read_run_stats
+from drawbot_motion import format_duration
+import drawbot_queue
+import drawbot_events
+from drawbot_queue import JobQueue, JobWorker
+from drawbot_checkpoint import load_checkpoint
+from drawbot_fleet import Fleet, bot_profile
+from drawbot_uploads import UploadIndex
+from drawbot_thumbnails import THUMBNAIL_NAME, CHECK_NAME, write_thumbnail
+from werkzeug.security import safe_join
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
 import socket
+import io
 
 import functools
 print = functools.partial(print, flush=True)
 
 
 app = Flask(__name__)
-app.config['EXECUTOR_TYPE'] = 'thread'
-app.config['EXECUTOR_MAX_WORKERS'] = 1
-
-executor = Executor(app)
-futures = []
 
 app.secret_key = 'your-secret-key-here'  # Add this line after creating the Flask app
 
 
 UPLOAD_FOLDER = 'data/uploaded'
-CURRENT_IMAGE_PATH = 'data/png_output.png'
 NO_DRAWING_IMAGE_PATH = 'static/no_drawing.png'
 ALLOWED_EXTENSIONS = {'svg'}
 app.config['UPLOAD_PATH'] = UPLOAD_FOLDER
 
-setup = BotSetup().standard_magnets().a3_paper().rodalm_21_30()
-fake = 'FAKE_DRAWBOT' in os.environ
-outputs = []
-if fake:
-    outputs.append(FakeDrawbotOutput(fake_delay=0.01,verbose=False))
-else:
-    outputs.append(SerialDrawbotOutput(verbose=False))
+# Conversions run in their own processes so they never queue behind a drawing on the executor,
+# and several uploads can convert at once. Spawn keeps the server's serial/MQTT state out of them.
+conversion_pool = ProcessPoolExecutor(max_workers=int(os.environ.get('DRAWBOT_CONVERT_WORKERS', os.cpu_count() or 1)),
+                                      mp_context=multiprocessing.get_context('spawn'))
 
-outputs.append(PNGOutput(output_path=CURRENT_IMAGE_PATH))
+# Thumbnails being drawn for older uploads, by upload directory
+thumbnail_backfills = {}
 
-controller = DrawbotControl(outputs=outputs,verbose=True)
+# Draw, control and convert jobs wait here, so a queued night of drawings survives a restart
+job_queue = JobQueue('data/jobs.db')
+# Controls like pen up jump ahead of queued drawings
+CONTROL_PRIORITY = 10
+
+# One DrawbotControl, queue worker and HA device per bot, from data/fleet.json or the environment
+fleet = Fleet.load()
+# The setup the upload form edits and new conversions use
+setup = fleet.setup_for()
+fake = 'FAKE_DRAWBOT' in os.environ
 
 print(f"Using fake drawbot: {fake}")
+print(f"Bots: {', '.join(f'{bot.name} ({bot.profile})' for bot in fleet)}")
+
+# Upload ids with their stats, so pages list recent uploads without scanning data/uploaded
+upload_index = UploadIndex('data/uploads.db', UPLOAD_FOLDER)
+upload_index.sync(estimate=fleet.default.controller.motion_model.predict)
+HISTORY_PAGE_SIZE = 50
+# Versioned /data URLs (?v=...) never change, so browsers may keep them this long without asking
+VERSIONED_MAX_AGE = 365 * 24 * 3600
+
+def run_draw_job(bot, job, cancel_event):
+    id = job['args']['id']
+    upload_index.touch(id)
+    bot.ha.set_target_image(f"{base_url}/data/uploaded/{id}/input.svg")
+    bot.browser_events.set_target_image(f"/data/uploaded/{id}/input.svg")
+    bot.controller.send_file(f"{UPLOAD_FOLDER}/{id}/output.gcode", job['setup'] or bot.setup, cancel_event,
+                             resume=job['args'].get('resume', False))
+
+def run_control_job(bot, job, cancel_event):
+    controller = bot.controller
+    command_tasks = {
+        'pen_up': controller.pen_up,
+        'pen_down': controller.pen_down,
+        'calibrate': controller.calibrate,
+        'home': controller.home,
+    }
+    bot.ha.set_target_image(None)
+    bot.browser_events.set_target_image(None)
+    command_tasks[job['args']['command']](cancel_event)
+
+def run_convert_job(job, cancel_event):
+    # Returns the pool's future, so conversions run in parallel while the job stays running
+    future = conversion_pool.submit(drawbot_conversion.process_file, job['args']['id'], job['setup'])
+    future.add_done_callback(functools.partial(index_conversion, job['args']['id']))
+    return future
+
+def index_conversion(id, future):
+    if future.exception() is not None:
+        return
+    stats = read_process_stats(id) or {}
+    features = stats.get('motion')
+    upload_index.update(id, strokes=stats.get('strokes'), commands=stats.get('commands_after'),
+                        estimate=fleet.default.controller.motion_model.predict(features) if features else None)
 
 def get_local_ip():
     """Get the local IP address of the machine"""
@@ -80,8 +135,21 @@ mqtt_server = "moominpappa.local" if fake else "192.168.2.6"
 
 
 
-#if not fake:
-ha = HAConnection(controller,config_url=base_url,mqtt_host=mqtt_server,image_path=CURRENT_IMAGE_PATH, no_drawing_image_path=NO_DRAWING_IMAGE_PATH)
+for bot in fleet:
+    bot.ha = HAConnection(bot.controller,config_url=base_url,mqtt_host=mqtt_server,image_path=bot.image_path,
+                          no_drawing_image_path=NO_DRAWING_IMAGE_PATH, name=bot.name if len(fleet) > 1 else None)
+
+# Conversions are safe to rerun from scratch, a drawing interrupted by a restart is not
+job_queue.recover(requeue_kinds=('convert',))
+# Each bot's worker feeds only that bot, claiming the next drawing that fits it whenever it is free,
+# so a drawing goes to whichever compatible bot frees up first. Another worker hands conversions to the pool.
+for bot in fleet:
+    bot.worker = JobWorker(job_queue, {'draw': functools.partial(run_draw_job, bot),
+                                       'control': functools.partial(run_control_job, bot)},
+                           name=f"drawbot-jobs-{bot.name}", bot=bot.name, profile=bot.profile)
+    bot.worker.start()
+conversion_worker = JobWorker(job_queue, {'convert': run_convert_job}, name="drawbot-conversions")
+conversion_worker.start()
 
 # Add this near the top with other global variables
 PAPER_SIZES = {
@@ -127,6 +195,10 @@ def update_base_url():
         server_port = request.environ.get('SERVER_PORT', '5000')
         base_url = f"http://{local_address}:{server_port}"
 
+@app.template_filter('timestamp')
+def timestamp_filter(value):
+    return datetime.fromtimestamp(value).strftime('%H:%M:%S') if value else ''
+
 @app.route("/", methods=['GET', 'POST'])
 def index():
     print("Showing index page...")
@@ -137,134 +209,288 @@ def design(id):
     global setup
     return process_request(request,id)
 
+@app.route("/design/<int:id>/status")
+def design_status(id):
+    return conversion_status(str(id))
+
+@app.route("/events")
+def events():
+    # One connection carries every bot's events, each naming its bot, unless ?bot= picks one
+    if request.args.get('bot'):
+        stream = fleet.get(request.args.get('bot')).browser_events.stream(
+            offset=request.args.get('offset', 0, type=int), generation=request.args.get('generation'))
+    else:
+        stream = drawbot_events.stream([bot.browser_events for bot in fleet])
+    return Response(stream_with_context(stream), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/metrics")
+def metrics():
+    if request.args.get('bot'):
+        return jsonify(fleet.get(request.args.get('bot')).metrics())
+    # Every bot's metrics, plus the default bot's at the top level as before
+    metrics = fleet.default.metrics()
+    metrics['bots'] = fleet.metrics()
+    return jsonify(metrics)
+
+@app.route("/strokes")
+def strokes():
+    """Segments drawn so far, starting after the client's last offset"""
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', 50000, type=int)
+    stroke_log_path = fleet.get(request.args.get('bot')).stroke_log_path
+    meta, offset, points = read_stroke_log(stroke_log_path, offset, limit)
+    if meta is None:
+        return jsonify({'generation': None, 'offset': 0, 'next': 0, 'points': []})
+    reset = request.args.get('generation') not in (None, meta['generation'])
+    if reset:
+        # A new drawing has started since the client last asked, send it from the beginning
+        meta, offset, points = read_stroke_log(stroke_log_path, 0, limit)
+    return jsonify({
+        'generation': meta['generation'],
+        'reset': reset,
+        'area': {k: meta[k] for k in ('x_margins', 'minimum_y_offset', 'width', 'height')},
+        'offset': offset,
+        'next': offset + len(points),
+        'points': np.round(points, 2).tolist(),
+    })
+
+@app.route("/strokes.png")
+def strokes_png():
+    image = render_stroke_log(fleet.get(request.args.get('bot')).stroke_log_path, max_size=min(request.args.get('size', 1024, type=int), 4096))
+    if image is None:
+        return send_from_directory('static', 'no_drawing.png')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG', compress_level=1)
+    buffer.seek(0)
+    return send_file(buffer, mimetype='image/png')
+
+@app.route("/tiles/info.json")
+def tiles_info():
+    """Zoom levels and area of the tiled preview, or nulls before anything has been drawn"""
+    return jsonify(fleet.get(request.args.get('bot')).tiles.info())
+
+@app.route("/tiles/<int:z>/<int:x>/<int:y>.png")
+def tile(z, x, y):
+    """One 256px tile of the drawing so far; zoom 0 is the whole drawing in one tile"""
+    found = fleet.get(request.args.get('bot')).tiles.tile(z, x, y)
+    if found is None:
+        abort(404)
+    png, etag = found
+    response = Response(png, mimetype='image/png')
+    # Tiles change as the bot draws over them, so clients revalidate and get a 304 if it hasn't
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route("/history")
+def history():
+    page = max(request.args.get('page', 1, type=int), 1)
+    total = upload_index.count()
+    uploads = upload_index.recent(HISTORY_PAGE_SIZE, (page - 1) * HISTORY_PAGE_SIZE)
+    context = page_context(bot_name=request.args.get('bot') or None)
+    return render_template('history.html', **context, uploads=[upload_info(upload) for upload in uploads],
+                           page=page, pages=max((total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE, 1), total=total)
+
+@app.route("/api/uploads")
+def api_uploads():
+    """Uploads, most recently changed first, `per_page` at a time"""
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', HISTORY_PAGE_SIZE, type=int), 1), 500)
+    return jsonify({
+        'page': page,
+        'per_page': per_page,
+        'total': upload_index.count(),
+        'uploads': upload_index.recent(per_page, (page - 1) * per_page),
+    })
+
+def backfill_thumbnail(upload_dir):
+    """Draw the thumbnail of an upload converted before there were any, off the request thread.
+
+    Compiling and rendering a large drawing takes seconds, so it runs on the conversion
+    pool once per server run, and the placeholder is shown until it is there.
+    """
+    if upload_dir not in thumbnail_backfills and os.path.exists(os.path.join(upload_dir, 'output.gcode')):
+        thumbnail_backfills[upload_dir] = conversion_pool.submit(write_thumbnail, upload_dir)
+
 @app.route('/data/<path:filepath>')
 def data(filepath):
-    return send_from_directory('data', filepath)
+    """Files under data/, revalidated against their ETag on every use unless the URL is versioned"""
+    path = safe_join('data', filepath)
+    if path and os.path.basename(path) == THUMBNAIL_NAME and not os.path.exists(path):
+        if filepath.startswith('uploaded/'):
+            backfill_thumbnail(os.path.dirname(path))
+        return send_from_directory('static', 'no_drawing.png', max_age=0)
+    versioned = 'v' in request.args
+    response = send_from_directory('data', filepath, max_age=VERSIONED_MAX_AGE if versioned else 0)
+    if versioned:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
 
 def process_request(request,id=None):
     global setup
-    global futures
     command_regex = r"command_(.*)"
     task_regex = r"task_(.*)"
     print(f"request: {request}")
     print(f"ID: {id}")
+    # Empty means any bot that fits the drawing
+    bot_name = request.values.get('bot') or None
     if request.method == 'POST':
         if request.form.get('action') == 'reprocess' and id:
             # Reprocess existing file
             setup = form_to_setup(request.form)
-            process_file(str(id), setup)
+            submit_conversion(str(id), setup)
             return redirect(f'/design/{id}')
         elif request.form.get('control'):
-            future = handle_drawbot_command(request.form.get('control'),id)
-            if future:
-                futures.append(future)  # Store the future for tracking
+            handle_drawbot_command(request.form.get('control'),id,bot_name)
         elif request.form.get('cancel_task'):
             cancel_drawbot_task(request.form.get('cancel_task'))
+        elif request.form.get('pause_task'):
+            pause_drawbot_task(request.form.get('pause_task'), 'pause')
+        elif request.form.get('resume_task'):
+            pause_drawbot_task(request.form.get('resume_task'), 'resume')
+        elif request.form.get('move_job'):
+            # "<job id>:-1" runs the job sooner, "<job id>:1" later
+            job_id, _, direction = request.form.get('move_job').partition(':')
+            if not job_id.isdecimal() or direction not in ('-1', '1'):
+                abort(400)
+            job_queue.move(int(job_id), int(direction))
         elif good_file():
             # Handle new file upload
             print("Got a file uploaded!")
             id = upload_svg_file(request.files['file'], request.form, id)
-            process_file(str(id), setup)
+            submit_conversion(str(id), setup)
             return redirect(f'/design/{id}')
 
-    # Clean up completed tasks before rendering
-    futures = [f for f in futures if not f.done()]
-    
-    # Get a list of the most recent 10 directories in the data/upload folder
-    upload_dir = os.path.join(app.config['UPLOAD_PATH'])
-    recent_dirs = sorted(os.listdir(upload_dir), key=lambda x: os.path.getmtime(os.path.join(upload_dir, x)), reverse=True)[:10]
-    # For each directory, make a dict with the id, modified time, link to the design page and to the uploaded SVG file
-    recent_dirs_info = []
-    for dir in recent_dirs:
-        dir_path = os.path.join(upload_dir, dir)
-        dir_id = dir
-        modified_time = datetime.fromtimestamp(os.path.getmtime(dir_path)).strftime('%Y-%m-%d %H:%M:%S')
-        design_link = f"/design/{dir_id}"
-        svg_link = f"/data/uploaded/{dir_id}/input.svg"
-        recent_dirs_info.append({'id': dir_id, 'modified_time': modified_time, 'design_link': design_link, 'svg_link': svg_link})
-    
     print(f"ID for render: {id}")
-    return render_template('design.html' if id else 'index.html', 
-                         id=id, 
-                         setup=setup,
-                         tasks=futures,
-                         recent_files=recent_dirs_info,
-                         sizes=PAPER_SIZES)
-
-def handle_drawbot_command(command,id=None):
+    return render_template('design.html' if id else 'index.html', **page_context(id, bot_name))
+
+def upload_info(upload):
+    """An upload index entry with the links and text the templates show"""
+    return dict(upload,
+                modified_time=datetime.fromtimestamp(upload['modified']).strftime('%Y-%m-%d %H:%M:%S'),
+                design_link=f"/design/{upload['id']}",
+                svg_link=f"/data/uploaded/{upload['id']}/input.svg",
+                # Versioned by the last change, which a conversion always is, so it can be cached for good
+                thumbnail_link=f"/data/uploaded/{upload['id']}/{THUMBNAIL_NAME}?v={int(upload['modified'] * 1000)}",
+                estimate_text=format_duration(upload['estimate']) if upload['estimate'] else None)
+
+def page_context(id=None, bot_name=None):
+    """Everything base.html and the controls need, plus the design's details if there is one"""
+    return dict(id=id,
+                setup=setup,
+                bots=list(fleet),
+                selected_bot=bot_name,
+                paused_bots=[bot.name for bot in fleet if bot.controller.paused],
+                jobs=job_queue.jobs(kinds=['draw', 'control']),
+                finished_jobs=job_queue.jobs(states=(drawbot_queue.DONE, drawbot_queue.FAILED, drawbot_queue.CANCELLED),
+                                             kinds=['draw', 'control'], limit=5),
+                recent_files=[upload_info(upload) for upload in upload_index.recent(10)],
+                stats=read_process_stats(id) if id else None,
+                run_stats=read_run_stats(f"{UPLOAD_FOLDER}/{id}/run_stats.json") if id else None,
+                estimate=time_estimate(id, bot_name) if id else None,
+                checkpoint=load_checkpoint(f"{UPLOAD_FOLDER}/{id}/output.gcode") if id else None,
+                conversion=conversion_status(str(id)) if id else None,
+                check_image=check_image(id) if id else None,
+                sizes=PAPER_SIZES)
+
+def check_image(id):
+    """The design's check raster, or the converter's check SVG for uploads converted before there was one"""
+    if os.path.exists(f"{UPLOAD_FOLDER}/{id}/{CHECK_NAME}"):
+        return f"/data/uploaded/{id}/{CHECK_NAME}"
+    return f"/data/uploaded/{id}/check.svg"
+
+def time_estimate(id, bot_name=None):
+    """Predicted drawing time for a converted design, from the bot's calibrated motion model"""
+    # Uploads converted before the stats had these get no estimate, rather than a parse of
+    # the whole drawing on every page view
+    features = (read_process_stats(id) or {}).get('motion')
+    if not features:
+        return None
+    model = fleet.get(bot_name).controller.motion_model
+    return {'text': format_duration(model.predict(features)), 'runs': len(model.observations)}
+
+def pinned_bot_error(bot_name, setup):
+    """Why a drawing for setup can't be pinned to bot_name, or None if it can (or isn't pinned)"""
+    if bot_name is None:
+        return None
+    bot = fleet.bots.get(bot_name)
+    if bot is None:
+        return f"There is no bot called {bot_name}"
+    if bot.profile != bot_profile(setup):
+        return f"{bot_name} is {bot.profile}, the drawing was converted for {bot_profile(setup)}"
+    return None
+
+def handle_drawbot_command(command,id=None,bot_name=None):
     global setup
-    print(f"handle_drawbot_command: {command}")
-    
-    command_tasks = {
-        'pen_up': [controller.pen_up],
-        'pen_down': [controller.pen_down],
-        'calibrate': [controller.calibrate],
-        'home': [controller.home],
-        'draw_file': [controller.send_file,f"data/uploaded/{id}/output.gcode",setup]
-    }
-    
-    if command in command_tasks:
-        print(f"Submitting command: {command}")
-        cancel_event = threading.Event()
-        print(f"Command tasks for {command}: {command_tasks[command]}")
-        if len(command_tasks[command]) > 1:
-            print(f"Submitting with args: func={command_tasks[command][0]}, args={command_tasks[command][1:]}, cancel_event={cancel_event}")
-            future = executor.submit(command_tasks[command][0], *command_tasks[command][1:], cancel_event)
-        else:
-            print(f"Submitting without args: func={command_tasks[command][0]}, cancel_event={cancel_event}")
-            future = executor.submit(command_tasks[command][0], cancel_event)
-        
-        # Add metadata including unique ID to the future
-        future.command = command
-        future.start_time = datetime.now()
-        future.task_id = str(uuid.uuid4())
-        future.cancel_event = cancel_event  # Store the event on the future
-        
-        # Add a done callback to handle any errors
-        def handle_future_error(future):
-            try:
-                # This will raise the exception if there was one
-                future.result()
-            except Exception as e:
-                import traceback
-                print(f"\nError in future execution for command '{command}':")
-                print(f"Error type: {type(e).__name__}")
-                print(f"Error message: {str(e)}")
-                print("Full stack trace:")
-                traceback.print_exc()
-                print(f"\nCommand details:")
-                print(f"Function: {command_tasks[command][0]}")
-                if len(command_tasks[command]) > 1:
-                    print(f"Arguments: {command_tasks[command][1:]}")
-        
-        future.add_done_callback(handle_future_error)
-        
-        if command == "draw_file":
-            # Get the absolute path to the input.svg file
-            base_url = url_for(f"index",_external=True)
-            image_url = f"{base_url}/data/uploaded/{id}/input.svg"
-            print(f"Setting image URL: {image_url}")
-            ha.set_target_image(image_url)
-        else:
-            ha.set_target_image(None)
-        
-        print(f"Future: {future}")
-        return future
+    print(f"handle_drawbot_command: {command} on {bot_name or 'any bot'}")
+    if command in ('draw_file', 'resume_file') and id:
+        if command == 'resume_file':
+            # Continue an interrupted drawing from its checkpoint, on the bot the paper is on
+            checkpoint = load_checkpoint(f"{UPLOAD_FOLDER}/{id}/output.gcode") or {}
+            if checkpoint.get('bot') in fleet.bots:
+                bot_name = checkpoint['bot']
+        # A job pinned to a bot of another geometry would wait in the queue forever
+        error = pinned_bot_error(bot_name, setup)
+        if error:
+            flash(error)
+            return None
+        if not fleet.compatible(setup):
+            flash(f"No bot is {bot_profile(setup)}, the drawing will wait until one is")
+        # The setup is stored with the job, so later form changes don't leak into a queued drawing.
+        # Without a bot it goes to whichever bot of the same geometry is free first.
+        args = {'id': str(id), 'resume': True} if command == 'resume_file' else {'id': str(id)}
+        job_id = job_queue.submit('draw', args, setup=setup, bot=bot_name, profile=bot_profile(setup))
+    elif command in ('pen_up', 'pen_down', 'home') and send_control(fleet.get(bot_name), command):
+        return None
+    elif command in ('pen_up', 'pen_down', 'calibrate', 'home'):
+        # Calibrating takes a while, and a pen down or home would spoil a drawing that isn't paused
+        job_id = job_queue.submit('control', {'command': command}, priority=CONTROL_PRIORITY,
+                                  bot=fleet.get(bot_name).name)
     else:
         print(f"Unknown command: {command}")
         return None
+    print(f"Queued {command} as job {job_id}")
+    return job_id
 
 def cancel_drawbot_task(task_id):
     print(f"cancel_drawbot_task: {task_id}")
-    # Find and cancel the future with matching ID
-    for future in futures:
-        if hasattr(future, 'task_id') and future.task_id == task_id:
-            # Set the cancel event
-            future.cancel_event.set()
-            #future.cancel()  # Still call cancel() for good measure
-            print(f"Cancelled task: {future.command}")
-            executor.submit(controller.pen_up)
-            break
+    job = job_queue.get(int(task_id))
+    if job is None:
+        return
+    bot = fleet.bots.get(job['bot'])
+    if job['state'] == drawbot_queue.RUNNING:
+        if bot is None or not bot.worker.cancel(job['id']):
+            return
+        # Wakes a paused drawing, which then stops with the pen up like any cancelled block.
+        # Before its block has started, raise the pen now; the block stops as soon as it starts.
+        if not send_control(bot, 'stop'):
+            send_control(bot, 'pen_up')
+    elif not job_queue.cancel(job['id']):
+        return
+    print(f"Cancelled job {job['id']} ({job['kind']} {job['args']})")
+
+def pause_drawbot_task(task_id, command):
+    """Pause or resume the running job on its bot"""
+    job = job_queue.get(int(task_id))
+    if job is None or job['state'] != drawbot_queue.RUNNING or job['bot'] not in fleet.bots:
+        return
+    if not send_control(fleet.bots[job['bot']], command):
+        flash(f"Could not {command} job {job['id']}")
+
+def send_control(bot, command) -> bool:
+    """Carry out a control command on the bot now rather than queueing it; False if it can't be"""
+    try:
+        if not bot.controller.control(command):
+            return False
+    except Exception as e:
+        flash(f"{command} failed on {bot.name}: {e}")
+        return True
+    # Sent straight away, or slipped in between the commands of the drawing
+    print(f"Sent {command} to {bot.name}")
+    return True
 
 def rand_id():
     return ''.join(random.choice(string.digits) for x in range(6))
@@ -284,6 +510,7 @@ def upload_svg_file(file,form,id=None):
     path = os.path.join(dir_path, "input.svg")
     print(f"Saving to {path}")
     file.save(path)
+    upload_index.add(str(id))
     return id
 
 def good_file():
@@ -305,20 +532,34 @@ def good_file():
         return False
     return True
 
-def process_file(id,setup:BotSetup):
-    processor = TransformerSVGPathTools()
-    processor.pipeline(setup=setup,
-        input_svg=f"data/uploaded/{id}/input.svg",
-        processed_svg=f"data/uploaded/{id}/processed.svg",
-        output_gcode=f"data/uploaded/{id}/output.gcode",
-        check_gcode=f"data/uploaded/{id}/gcode_check.svg",
-        annot_check_gcode=f"data/uploaded/{id}/check.svg"
-        )
+def submit_conversion(id, setup:BotSetup):
+    """Queue an upload for conversion in the conversion pool"""
+    job = job_queue.latest('convert', id)
+    if job and job['state'] in drawbot_queue.ACTIVE_STATES:
+        flash('Still converting this drawing, try again when it has finished')
+        return job['id']
+    print(f"Submitting conversion of {id}")
+    # The setup is pickled at submission, so later form changes don't leak into this conversion
+    return job_queue.submit('convert', {'id': id}, setup=setup)
+
+def conversion_status(id):
+    job = job_queue.latest('convert', id)
+    if job is None:
+        return {'state': 'none'}
+    if job['state'] in drawbot_queue.ACTIVE_STATES:
+        started = datetime.fromtimestamp(job['started'] or job['created'])
+        return {'state': 'converting', 'started': started.strftime('%H:%M:%S')}
+    if job['state'] == drawbot_queue.FAILED:
+        return {'state': 'failed', 'error': job['error']}
+    return {'state': 'done'}
 
 def form_to_setup(form):
     global setup
     print(f"form_to_setup Start: {setup}")
     print(f"form: {form}")
+    if form.get('bot') in fleet.bots:
+        # Convert for the chosen bot's geometry
+        fleet.bots[form['bot']].apply_geometry(setup)
     if 'bot_width' in form:
         setup.bot_width=int(form['bot_width'])
     if 'bot_height' in form:
@@ -331,6 +572,8 @@ def form_to_setup(form):
         setup.drawing_width=int(form['drawing_width'])
     if 'drawing_height' in form:
         setup.drawing_height=int(form['drawing_height'])
+    if 'simplify_tolerance' in form:
+        setup.simplify_tolerance = max(0.0, float(form['simplify_tolerance']))
     if 'fill_target' in form:
         setup.fill_target= True if form['fill_target'] == 'on' else False
     if 'paper_offset' in form:
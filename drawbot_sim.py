@@ -0,0 +1,308 @@
+# Simulated drawbot firmware, for load testing the serial path without the robot.
+#
+# Use SimulatedSerialPort in place of serial.Serial:
+#   SerialDrawbotOutput(window=8, serial_factory=lambda: SimulatedSerialPort(planner_size=8))
+# or run this file to expose the simulator as a virtual serial device:
+#   python drawbot_sim.py --speedup 10
+# and point SerialDrawbotOutput (or anything else that talks serial) at the path it prints.
+
+import argparse
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import drawbot_gcode
+from drawbot_gcode import OP_PEN, OP_MOVE
+from drawbot_motion import HOME, string_lengths
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+class SimulatedSerialPort:
+    """Stands in for serial.Serial, with a timing model of the drawbot firmware.
+
+    Bytes cross the link at the baud rate into a receive buffer of `rx_buffer`
+    bytes; anything arriving while it is full is lost, as on the microcontroller.
+    Complete commands move from there into a planner of `planner_size` commands
+    once it has room, and run one after another. A move takes the larger string
+    length change of the polar bot divided by the drawing or travel speed.
+
+    "ok" is sent when a command enters the planner, or once it has finished if
+    ok_when_done is set. A fraction of them arrive late or never arrive.
+
+    Everything is computed from the time commands are written, so no thread runs
+    and speedup makes the simulated bot that many times faster than real time.
+    """
+    def __init__(self, planner_size=1, rx_buffer=64, baud=None, draw_speed=20.0, travel_speed=40.0,
+                 pen_time=0.3, command_time=0.002, calibrate_time=5.0, ok_when_done=True,
+                 late_ok_rate=0.0, late_ok_delay=0.5, drop_ok_rate=0.0, bot_width=760.0, speedup=1.0, seed=0,
+                 keep_received=1000):
+        """
+        Args:
+            planner_size: Commands the firmware can queue, including the one executing
+            rx_buffer: Bytes the firmware's serial receive buffer holds
+            baud: Link speed, defaults to the baudrate set on the port before open()
+            draw_speed: String speed in mm/s with the pen down
+            travel_speed: String speed in mm/s with the pen up
+            pen_time: Seconds to raise or lower the pen
+            command_time: Seconds the firmware spends on any command
+            calibrate_time: Seconds a calibration ("c") takes
+            ok_when_done: Send "ok" when a command has finished rather than when it is planned
+            late_ok_rate: Fraction of "ok"s delayed by late_ok_delay seconds
+            drop_ok_rate: Fraction of "ok"s that are never sent
+            bot_width: Distance between the string motors in mm
+            speedup: Run the simulated bot this many times faster than real time
+            seed: Seed for the late and dropped "ok"s
+            keep_received: How many of the latest commands received to keep for inspection;
+                a long load test would otherwise hold every command it sent
+        """
+        self.planner_size = max(1, planner_size)
+        self.rx_buffer = rx_buffer
+        self.baud = baud
+        self.draw_speed = draw_speed
+        self.travel_speed = travel_speed
+        self.pen_time = pen_time
+        self.command_time = command_time
+        self.calibrate_time = calibrate_time
+        self.ok_when_done = ok_when_done
+        self.late_ok_rate = late_ok_rate
+        self.late_ok_delay = late_ok_delay
+        self.drop_ok_rate = drop_ok_rate
+        self.bot_width = bot_width
+        self.speedup = speedup
+        self.random = random.Random(seed)
+
+        # Attributes set by SerialDrawbotOutput, as on serial.Serial
+        self.port = None
+        self.timeout = None
+        self.writeTimeout = None
+        self.baudrate = None
+        self.is_open = False
+
+        self.received = deque(maxlen=keep_received)
+        self.received_count = 0
+        self.overflows = 0
+        self.dropped_oks = 0
+        self.late_oks = 0
+        self.busy_time = 0.0
+        self.max_planned = 0
+        self._cond = threading.Condition()
+        # The pen stays where it was when the port is closed and opened again
+        self._pen_down = False
+        self._lengths = string_lengths(HOME[0], HOME[1], self.bot_width)
+        self._reset()
+
+    def _reset(self):
+        self._link_free = 0.0
+        self._planner = deque()
+        self._rx = deque()
+        self._last_end = 0.0
+        self._oks = deque()
+        self._last_ok = 0.0
+        self.first_write = None
+
+    def open(self):
+        with self._cond:
+            if self.baud is None:
+                self.baud = int(self.baudrate or 57600)
+            self._reset()
+            self.is_open = True
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+
+    def _byte_time(self) -> float:
+        # 8N1 framing, ten bits on the wire per byte
+        return 10.0 / self.baud
+
+    def write(self, data: bytes):
+        if not self.is_open:
+            raise IOError("Attempting to use a port that is not open")
+        text = data.decode('utf-8')
+        commands = text.split("\n")
+        if text.endswith("\n"):
+            commands = commands[:-1]
+        now = time.monotonic()
+        with self._cond:
+            if self.first_write is None:
+                self.first_write = now
+            for command in commands:
+                size = len(command.encode('utf-8')) + 1
+                arrived = max(now, self._link_free) + size * self._byte_time()
+                self._link_free = arrived
+                self.received.append(command)
+                self.received_count += 1
+                if self._rx_bytes(arrived) + size > self.rx_buffer:
+                    # Receive buffer overrun, the firmware never sees this command
+                    self.overflows += 1
+                    continue
+                self._plan(command.strip(), size, arrived)
+            self._cond.notify_all()
+        return len(data)
+
+    def _rx_bytes(self, at: float) -> int:
+        # Commands still waiting for a planner slot occupy the receive buffer
+        while self._rx and self._rx[0][0] <= at:
+            self._rx.popleft()
+        return sum(size for _, size in self._rx)
+
+    def _plan(self, command: str, size: int, arrived: float):
+        while self._planner and self._planner[0] <= arrived:
+            self._planner.popleft()
+        planned = arrived
+        if len(self._planner) >= self.planner_size:
+            # Waits in the receive buffer until the oldest planned command finishes
+            planned = self._planner[-self.planner_size]
+        self._rx.append((planned, size))
+        start = max(planned, self._last_end)
+        duration = self._duration(command) / self.speedup
+        end = start + duration
+        self._last_end = end
+        self._planner.append(end)
+        self.busy_time += duration
+        self.max_planned = max(self.max_planned, sum(1 for t in self._planner if t > planned))
+        self._acknowledge(end if self.ok_when_done else planned)
+
+    def _duration(self, command: str) -> float:
+        op, x, y = drawbot_gcode.parse_command(command)
+        if op == OP_PEN:
+            self._pen_down = x == 1
+            return self.command_time + self.pen_time
+        if op == OP_MOVE:
+            lengths = string_lengths(x, y, self.bot_width)
+            distance = max(abs(lengths[0] - self._lengths[0]), abs(lengths[1] - self._lengths[1]))
+            self._lengths = lengths
+            return self.command_time + distance / (self.draw_speed if self._pen_down else self.travel_speed)
+        if command == 'c':
+            return self.calibrate_time
+        return self.command_time
+
+    def _acknowledge(self, at: float):
+        roll = self.random.random()
+        if roll < self.drop_ok_rate:
+            self.dropped_oks += 1
+            return
+        if roll < self.drop_ok_rate + self.late_ok_rate:
+            self.late_oks += 1
+            at += self.late_ok_delay / self.speedup
+        # The serial line is first in, first out, so a late "ok" holds back every one after it
+        self._last_ok = max(at, self._last_ok) + 3 * self._byte_time()
+        self._oks.append(self._last_ok)
+
+    def readline(self) -> bytes:
+        deadline = time.monotonic() + (self.timeout if self.timeout is not None else 1e9)
+        with self._cond:
+            while self.is_open:
+                now = time.monotonic()
+                if self._oks and self._oks[0] <= now:
+                    self._oks.popleft()
+                    return b"ok\n"
+                if now >= deadline:
+                    return b""
+                wait = deadline - now
+                if self._oks:
+                    wait = min(wait, self._oks[0] - now)
+                self._cond.wait(max(wait, 0))
+            return b""
+
+    def utilisation(self) -> float:
+        """Fraction of the time since the first write that the simulated bot was moving"""
+        if self.first_write is None:
+            return 0.0
+        elapsed = max(time.monotonic(), self._last_end) - self.first_write
+        return min(float(self.busy_time / elapsed), 1.0) if elapsed > 0 else 0.0
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                'received': self.received_count,
+                'overflows': self.overflows,
+                'dropped_oks': self.dropped_oks,
+                'late_oks': self.late_oks,
+                'max_planned': self.max_planned,
+                'utilisation': self.utilisation(),
+            }
+
+
+class VirtualSerialDevice:
+    """A pseudo-terminal with a SimulatedSerialPort on the far end.
+
+    `path` can be opened like the robot's /dev/ttyACM0. Commands must be newline
+    terminated, or written one at a time and followed by a pause, as
+    SerialDrawbotOutput does when it waits for each "ok".
+    """
+    def __init__(self, unframed_gap=0.005, **simulator_args):
+        import pty
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+        self.unframed_gap = unframed_gap
+        self.simulator = SimulatedSerialPort(**simulator_args)
+        self.simulator.timeout = 0.1
+        self.simulator.open()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._receive, name="drawbot-sim-rx", daemon=True),
+                         threading.Thread(target=self._send, name="drawbot-sim-tx", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        self._stop.set()
+        self.simulator.close()
+        for thread in self._threads:
+            thread.join(timeout=1)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def _receive(self):
+        import select
+        pending = b""
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self.master], [], [], self.unframed_gap if pending else 0.1)
+            if readable:
+                pending += os.read(self.master, 4096)
+                lines, _, pending = pending.rpartition(b"\n")
+                if lines:
+                    self.simulator.write(lines + b"\n")
+            elif pending:
+                # Nothing more arrived, so this was a whole command sent without a newline
+                self.simulator.write(pending)
+                pending = b""
+
+    def _send(self):
+        while not self._stop.is_set():
+            line = self.simulator.readline()
+            if line:
+                os.write(self.master, line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a simulated drawbot on a virtual serial device")
+    parser.add_argument('--planner-size', type=int, default=1)
+    parser.add_argument('--rx-buffer', type=int, default=64)
+    parser.add_argument('--baud', type=int, default=57600)
+    parser.add_argument('--speedup', type=float, default=1.0)
+    parser.add_argument('--ok-when-planned', action='store_true', help="Acknowledge commands as they are planned")
+    parser.add_argument('--late-ok-rate', type=float, default=0.0)
+    parser.add_argument('--drop-ok-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    device = VirtualSerialDevice(planner_size=args.planner_size, rx_buffer=args.rx_buffer, baud=args.baud,
+                                 speedup=args.speedup, ok_when_done=not args.ok_when_planned,
+                                 late_ok_rate=args.late_ok_rate, drop_ok_rate=args.drop_ok_rate)
+    print(f"Simulated drawbot on {device.path}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"Simulator: {device.simulator.metrics()}")
+    except KeyboardInterrupt:
+        device.close()
+
+
+if __name__ == "__main__":
+    main()
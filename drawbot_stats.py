@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+class LatencyHistogram:
+    """Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are recorded in microseconds into buckets whose width doubles with each
+    power of two, with `sub_buckets` linear steps per power, so any recorded value is
+    reported to within 1/sub_buckets of its true value across the whole range
+    at constant memory.
+    """
+    def __init__(self, sub_bucket_bits=6):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds: float):
+        micros = int(seconds * 1e6)
+        shift = max(0, micros.bit_length() - self.sub_bucket_bits)
+        key = (shift, micros >> shift)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """Value in seconds below which p percent of recorded values fall"""
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        seen = 0
+        for shift, sub in sorted(self.counts, key=lambda k: k[1] << k[0]):
+            seen += self.counts[(shift, sub)]
+            if seen >= target:
+                # Report the middle of the bucket
+                return ((sub << shift) + (1 << shift) / 2) / 1e6
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0.0,
+            'min': self.min or 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max or 0.0,
+        }
+
+
+class RunStats:
+    """Per-stage timing histograms for one send_block run.
+
+    Stages are recorded from the send loop, the serial reader thread and the
+    listener dispatcher, so recording is guarded by a lock.
+    """
+    def __init__(self, name: str = None):
+        self.name = name
+        self.histograms = {}
+        self.start_time = time.time()
+        self.end_time = None
+        # Seconds spent paused, left out of the elapsed time
+        self.paused = 0.0
+        self.commands = 0
+        self.result = None
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def finish(self, commands: int, result: str):
+        self.end_time = time.time()
+        self.commands = commands
+        self.result = result
+
+    def summary(self) -> dict:
+        end_time = self.end_time or time.time()
+        with self._lock:
+            stages = {stage: histogram.summary() for stage, histogram in self.histograms.items()}
+        elapsed = end_time - self.start_time - self.paused
+        return {
+            'name': self.name,
+            'start_time': self.start_time,
+            'elapsed': elapsed,
+            'paused': self.paused,
+            'commands': self.commands,
+            'commands_per_second': self.commands / elapsed if elapsed > 0 else 0.0,
+            'result': self.result,
+            'stages': dict(sorted(stages.items(), key=lambda item: -item[1]['total'])),
+        }
+
+    def write(self, path: str):
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.summary(), f, indent=1)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not write run stats to {path}: {e}")
+
+
+def read_run_stats(path: str):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
@@ -0,0 +1,150 @@
+# Raster previews of converted drawings: small thumbnails for the upload lists and
+# a full check image for the design page. Pillow can't rasterize SVG, so they are
+# drawn from the parsed g-code, the pen-down strokes the bot will actually draw.
+# Strokes are found with array operations over the whole file and each one is drawn
+# with a single polyline call, rather than a line per command.
+
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import drawbot_gcode
+from drawbot_gcode import OP_PEN, OP_MOVE
+from drawbot_motion import HOME
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+THUMBNAIL_NAME = 'thumbnail.png'
+# Twice the size the lists show them at, so they stay sharp on high density screens
+THUMBNAIL_SIZE = 200
+CHECK_NAME = 'check.png'
+# Pixels per mm of the check image, and the most pixels along its longer side
+CHECK_SCALE = 4
+CHECK_MAX_SIZE = 4096
+
+
+def stroke_polylines(op: np.ndarray, x: np.ndarray, y: np.ndarray, start=HOME, pen_down=False) -> list:
+    """(k, 2) arrays of the points of each pen-down stroke, in bot coordinates
+
+    Args:
+        op, x, y: Command fields, as drawbot_gcode.parse_command gives them
+        start: Where the bot is before the first command
+        pen_down: Whether the pen is down before the first command
+    """
+    n = len(op)
+    if n == 0:
+        return []
+    is_pen = op == OP_PEN
+    # Pen state in effect at each command, carried forward from the last pen command
+    last_pen = np.where(is_pen, np.arange(n), -1)
+    np.maximum.accumulate(last_pen, out=last_pen)
+    pen_down = np.where(last_pen >= 0, x[np.maximum(last_pen, 0)] == 1, pen_down)
+
+    moves = np.flatnonzero(op == OP_MOVE)
+    points = np.empty((len(moves) + 1, 2))
+    points[0] = start
+    points[1:, 0] = x[moves]
+    points[1:, 1] = y[moves]
+    # Move i draws from points[i] to points[i + 1]; consecutive drawing moves make one stroke
+    drawing = np.concatenate(([False], pen_down[moves], [False])).astype(np.int8)
+    edges = np.diff(drawing)
+    firsts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return [points[a:b + 1] for a, b in zip(firsts, ends)]
+
+
+def draw_strokes(draw: ImageDraw.ImageDraw, strokes: list, offset, scale: float, fill, width: int):
+    """Draw each stroke as one polyline, mapping bot coordinates to (point - offset) * scale"""
+    offset = np.asarray(offset, dtype=float)
+    for stroke in strokes:
+        draw.line(((stroke - offset) * scale).ravel().tolist(), fill=fill, width=width)
+
+
+def file_strokes(filepath: str, records: np.ndarray = None):
+    """The pen-down strokes of a g-code file, or None if there is no file
+
+    Args:
+        records: The file's commands from drawbot_gcode.parse_file, if they are at hand
+    """
+    if records is None:
+        if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+            return None
+        records = drawbot_gcode.parse_file(filepath)
+    return stroke_polylines(records['op'], records['x'], records['y'])
+
+
+def render_gcode(filepath: str, max_size=THUMBNAIL_SIZE, line_color=0, bg_color=255, line_width=1, margin=0.04,
+                 records: np.ndarray = None):
+    """Render the strokes of a g-code file, cropped to the drawing, or None if there are none"""
+    strokes = file_strokes(filepath, records)
+    if not strokes:
+        return None
+    everything = np.concatenate(strokes)
+    low, high = everything.min(axis=0), everything.max(axis=0)
+    extent = np.maximum(high - low, 1e-6)
+    scale = max_size * (1 - 2 * margin) / extent.max()
+    size = np.maximum(np.ceil(extent * scale + 2 * margin * max_size), 1).astype(int)
+    offset = low - margin * max_size / scale
+    image = Image.new('L', (int(size[0]), int(size[1])), bg_color)
+    draw_strokes(ImageDraw.Draw(image), strokes, offset, scale, line_color, line_width)
+    return image
+
+
+def render_check(filepath: str, setup, scale=CHECK_SCALE, max_size=CHECK_MAX_SIZE, line_color=0, bg_color=255,
+                 line_width=1, records: np.ndarray = None):
+    """Render the strokes of a g-code file on the whole drawable area, as on the paper
+
+    Args:
+        filepath: The g-code file
+        setup: BotSetup giving the drawable area
+        scale: Pixels per mm
+        max_size: Reduce the scale so neither side exceeds this many pixels
+        records: The file's commands from drawbot_gcode.parse_file, if they are at hand
+    """
+    strokes = file_strokes(filepath, records)
+    if strokes is None:
+        return None
+    area_width = setup.bot_width - 2 * setup.x_margins
+    area_height = setup.bot_height - setup.minimum_y_offset
+    scale = min(scale, max_size / max(area_width, area_height, 1))
+    image = Image.new('L', (max(1, int(area_width * scale)), max(1, int(area_height * scale))), bg_color)
+    draw_strokes(ImageDraw.Draw(image), strokes, (setup.x_margins, setup.minimum_y_offset), scale,
+                 line_color, line_width)
+    return image
+
+
+def _save(image: Image.Image, path: str, **params):
+    # Written aside and renamed, so a browser never gets half an image
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            image.save(f, format='PNG', **params)
+        # mkstemp makes the file private, it should read like any other data file
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def write_thumbnail(upload_dir: str, records: np.ndarray = None) -> bool:
+    """Render upload_dir/thumbnail.png from its output.gcode; returns whether there was anything to draw"""
+    image = render_gcode(os.path.join(upload_dir, 'output.gcode'), records=records)
+    if image is None:
+        return False
+    _save(image, os.path.join(upload_dir, THUMBNAIL_NAME), optimize=True)
+    return True
+
+
+def write_check(upload_dir: str, setup, records: np.ndarray = None) -> bool:
+    """Render upload_dir/check.png from its output.gcode; returns False if there is none"""
+    image = render_check(os.path.join(upload_dir, 'output.gcode'), setup, records=records)
+    if image is None:
+        return False
+    # Mostly blank and up to 4096px, a quick zlib level keeps this a fraction of the conversion
+    _save(image, os.path.join(upload_dir, CHECK_NAME), compress_level=3)
+    return True
@@ -0,0 +1,178 @@
+# Tiled, zoomable preview of the drawing in progress, rendered on demand from the
+# stroke log. Memory depends on the strokes drawn and the tiles cached, never on
+# the paper size or zoom level.
+
+import io
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from drawbot_control import read_stroke_log
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+class StrokeTiles:
+    """A pyramid of tile_size square PNG tiles of a StrokeLogOutput log.
+
+    Zoom 0 fits the whole drawable area in one tile and each level doubles the
+    scale, up to max_scale pixels per mm. Tiles are rendered when first asked for
+    and kept in an LRU cache. New strokes in the log only evict the cached tiles
+    they cross, so a client polling the view it is looking at gets a cheap 304 for
+    every tile that hasn't changed.
+    """
+    def __init__(self, log_path: str, tile_size=256, max_scale=10.0, cache_tiles=512, line_mm=0.3,
+                 line_color=(0, 0, 0), bg_color=(220, 220, 190)):
+        """
+        Args:
+            log_path: The stroke log to render
+            tile_size: Width and height of a tile in pixels
+            max_scale: Pixels per mm at the deepest zoom level
+            cache_tiles: Rendered tiles to keep
+            line_mm: Pen width, never drawn narrower than a pixel
+        """
+        self.log_path = log_path
+        self.tile_size = tile_size
+        self.max_scale = max_scale
+        self.cache_tiles = cache_tiles
+        self.line_mm = line_mm
+        self.line_color = line_color
+        self.bg_color = bg_color
+        self.rendered = 0
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._reset(None)
+
+    def _reset(self, meta):
+        self.meta = meta
+        self.generation = meta['generation'] if meta else None
+        self.count = 0
+        self._points = np.zeros((1024, 3), dtype=np.float32)
+        self._cache.clear()
+
+    def _refresh(self):
+        """Take in any records added to the log, and evict the tiles they draw on"""
+        meta, _, points = read_stroke_log(self.log_path, self.count)
+        if meta is None:
+            self._reset(None)
+            return
+        if meta['generation'] != self.generation:
+            # A new drawing has started, begin again from the first record
+            self._reset(meta)
+            meta, _, points = read_stroke_log(self.log_path, 0)
+        if not len(points):
+            return
+        first = self.count
+        end = first + len(points)
+        if end > len(self._points):
+            grown = np.zeros((max(end, 2 * len(self._points)), 3), dtype=np.float32)
+            grown[:first] = self._points[:first]
+            self._points = grown
+        self._points[first:end] = points
+        self.count = end
+        if self._cache:
+            # Include the segment joining the previous last point to the first new one
+            self._invalidate(self._segments(max(first, 1), end))
+
+    def _segments(self, start: int, end: int):
+        """Indexes of the records ending drawn segments in start..end-1, and the segments' endpoints"""
+        index = np.arange(max(start, 1), end)
+        index = index[self._points[index, 2] == 1]
+        return index, self._points[index - 1, :2], self._points[index, :2]
+
+    def _invalidate(self, segments):
+        _, a, b = segments
+        if not len(a):
+            return
+        low, high = np.minimum(a, b), np.maximum(a, b)
+        for key in list(self._cache):
+            x0, y0, x1, y1 = self._bounds(*key)
+            if np.any((high[:, 0] >= x0) & (low[:, 0] <= x1) & (high[:, 1] >= y0) & (low[:, 1] <= y1)):
+                del self._cache[key]
+
+    def _area(self):
+        return max(self.meta['width'], 1e-6), max(self.meta['height'], 1e-6)
+
+    def _scale(self, z: int) -> float:
+        return self.tile_size / max(self._area()) * 2 ** z
+
+    def max_zoom(self) -> int:
+        return max(0, math.ceil(math.log2(self.max_scale / self._scale(0))))
+
+    def _tiles_across(self, z: int):
+        width, height = self._area()
+        scale = self._scale(z)
+        return math.ceil(width * scale / self.tile_size), math.ceil(height * scale / self.tile_size)
+
+    def _width_px(self, z: int) -> int:
+        return max(1, round(self.line_mm * self._scale(z)))
+
+    def _bounds(self, z: int, x: int, y: int):
+        """Area a tile covers in bot coordinates, widened by the line width"""
+        scale = self._scale(z)
+        span = self.tile_size / scale
+        pad = self._width_px(z) / scale
+        left = self.meta['x_margins'] + x * span
+        top = self.meta['minimum_y_offset'] + y * span
+        return left - pad, top - pad, left + span + pad, top + span + pad
+
+    def info(self) -> dict:
+        """What a client needs to lay out the tiles, or None if nothing has been drawn"""
+        with self._lock:
+            self._refresh()
+            if self.meta is None:
+                return None
+            return {
+                'generation': self.generation,
+                'tile_size': self.tile_size,
+                'max_zoom': self.max_zoom(),
+                'area': {k: self.meta[k] for k in ('x_margins', 'minimum_y_offset', 'width', 'height')},
+                'points': self.count,
+            }
+
+    def tile(self, z: int, x: int, y: int):
+        """PNG bytes of a tile and its ETag, or None if there is no such tile"""
+        with self._lock:
+            self._refresh()
+            if self.meta is None or not 0 <= z <= self.max_zoom():
+                return None
+            across, down = self._tiles_across(z)
+            if not (0 <= x < across and 0 <= y < down):
+                return None
+            key = (z, x, y)
+            cached = self._cache.get(key)
+            if cached is None:
+                cached = (self._render(z, x, y), f"{self.generation}-{z}-{x}-{y}-{self.count}")
+                self._cache[key] = cached
+                while len(self._cache) > self.cache_tiles:
+                    self._cache.popitem(last=False)
+            else:
+                self._cache.move_to_end(key)
+            return cached
+
+    def _render(self, z: int, x: int, y: int) -> bytes:
+        self.rendered += 1
+        scale = self._scale(z)
+        x0, y0, x1, y1 = self._bounds(z, x, y)
+        index, a, b = self._segments(1, self.count)
+        low, high = np.minimum(a, b), np.maximum(a, b)
+        visible = index[(high[:, 0] >= x0) & (low[:, 0] <= x1) & (high[:, 1] >= y0) & (low[:, 1] <= y1)]
+
+        image = Image.new('RGB', (self.tile_size, self.tile_size), self.bg_color)
+        if len(visible):
+            draw = ImageDraw.Draw(image)
+            width = self._width_px(z)
+            origin = np.array([self.meta['x_margins'] + x * self.tile_size / scale,
+                               self.meta['minimum_y_offset'] + y * self.tile_size / scale])
+            xy = (self._points[:self.count, :2] - origin) * scale
+            # Runs of consecutive visible segments are drawn as one polyline
+            breaks = np.flatnonzero(np.diff(visible) != 1) + 1
+            for run in np.split(visible, breaks):
+                draw.line(xy[run[0] - 1:run[-1] + 1].ravel().tolist(), fill=self.line_color, width=width)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=3)
+        return buffer.getvalue()
@@ -0,0 +1,148 @@
+# Index of uploaded drawings, kept in a local SQLite database so listing recent
+# uploads doesn't stat every directory under data/uploaded on each page.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+
+import functools
+print = functools.partial(print, flush=True)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    modified REAL NOT NULL,
+    size INTEGER,
+    strokes INTEGER,
+    commands INTEGER,
+    estimate REAL
+);
+CREATE INDEX IF NOT EXISTS uploads_modified ON uploads (modified);
+"""
+
+# Fields set from a conversion's process stats
+STATS_FIELDS = ('strokes', 'commands', 'estimate')
+
+
+class UploadIndex:
+    """Uploads with their size, stroke count and estimated drawing time, newest first.
+
+    The server adds an upload when it is saved and updates it when its conversion
+    finishes or it is drawn. Directories that appear some other way are picked up
+    by sync(), which only runs at startup.
+    """
+    def __init__(self, db_path='data/uploads.db', upload_dir='data/uploaded'):
+        self.db_path = db_path
+        self.upload_dir = upload_dir
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        """A connection that commits on success and is always closed"""
+        db = sqlite3.connect(self.db_path, timeout=30)
+        db.row_factory = sqlite3.Row
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def _process_stats(self, id: str) -> dict:
+        try:
+            with open(os.path.join(self.upload_dir, id, 'process_stats.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _svg_size(self, id: str) -> Optional[int]:
+        try:
+            return os.path.getsize(os.path.join(self.upload_dir, id, 'input.svg'))
+        except OSError:
+            return None
+
+    def add(self, id: str, modified: float = None):
+        """Record a new or replaced upload"""
+        now = modified or time.time()
+        with self._lock, self._connect() as db:
+            db.execute("INSERT INTO uploads (id, created, modified, size) VALUES (?, ?, ?, ?) "
+                       "ON CONFLICT(id) DO UPDATE SET modified = excluded.modified, size = excluded.size",
+                       (id, now, now, self._svg_size(id)))
+
+    def update(self, id: str, **fields):
+        """Set some of STATS_FIELDS for an upload and mark it as just modified"""
+        unknown = set(fields) - set(STATS_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown upload fields: {', '.join(sorted(unknown))}")
+        assignments = ''.join(f", {name} = ?" for name in fields)
+        with self._lock, self._connect() as db:
+            cursor = db.execute(f"UPDATE uploads SET modified = ?{assignments} WHERE id = ?",
+                                (time.time(), *fields.values(), id))
+        if not cursor.rowcount:
+            # Converted before it was indexed, e.g. an upload made before the index existed
+            self.add(id)
+            self.update(id, **fields)
+
+    def touch(self, id: str):
+        self.update(id)
+
+    def get(self, id: str) -> Optional[dict]:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM uploads WHERE id = ?", (id,)).fetchone()
+        return dict(row) if row else None
+
+    def recent(self, limit=10, offset=0) -> List[dict]:
+        """Most recently modified uploads first"""
+        with self._connect() as db:
+            rows = db.execute("SELECT * FROM uploads ORDER BY modified DESC, id LIMIT ? OFFSET ?",
+                              (limit, offset)).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self) -> int:
+        with self._connect() as db:
+            return db.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+
+    def sync(self, estimate=None):
+        """Index upload directories missing from the index, from their files
+
+        Rows of upload directories that have since been deleted are removed.
+
+        Args:
+            estimate: Callable returning the drawing time in seconds for a conversion's
+                motion features, or None to leave the estimates empty
+        """
+        try:
+            ids = set(os.listdir(self.upload_dir))
+        except FileNotFoundError:
+            return
+        with self._connect() as db:
+            known = {row['id'] for row in db.execute("SELECT id FROM uploads")}
+        rows = []
+        for id in ids - known:
+            path = os.path.join(self.upload_dir, id)
+            if not os.path.isdir(path):
+                continue
+            stats = self._process_stats(id)
+            features = stats.get('motion')
+            modified = os.path.getmtime(path)
+            rows.append((id, modified, modified, self._svg_size(id), stats.get('strokes'),
+                         stats.get('commands_after'),
+                         estimate(features) if estimate and features else None))
+        gone = [(id,) for id in known if not os.path.isdir(os.path.join(self.upload_dir, id))]
+        if rows:
+            print(f"Indexing {len(rows)} uploads")
+        if gone:
+            print(f"Removing {len(gone)} deleted uploads from the index")
+        if rows or gone:
+            with self._lock, self._connect() as db:
+                db.executemany("INSERT OR IGNORE INTO uploads (id, created, modified, size, strokes, commands, estimate) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                db.executemany("DELETE FROM uploads WHERE id = ?", gone)